@@ -3,8 +3,16 @@ import matplotlib.pyplot as plt # also to solve import ordering problems in bioc
 from deepaclive.receiver import Receiver
 from deepaclive.sender import Sender
 from deepaclive.refilter import Refilterer
-from deepaclive.tests import run_tests
+from deepaclive.tests import run_tests, generate_sample_bams
+from deepaclive.retention import RetentionPolicy
+from deepaclive.index import ReadIndex, get_index_path
+from deepaclive.manifest import get_manifest_path
+from deepaclive.replay import Replayer, get_schedule, get_recorded_schedule
+from deepaclive.profiling import UnitProfiler, parse_units
 import argparse
+import json
+import os
+import tempfile
 from deepaclive import __version__
 from multiprocessing import Process
 from deepac.command_line import add_global_parser, global_setup
@@ -32,13 +40,30 @@ def run_tester(args):
     run_tests(args.command, args.model, n_cpus, args.keep, args.scale, tpu_resolver)
 
 
+def get_retention(args, directory, wait_for=()):
+    if args.keep_cycles is None and args.disk_budget is None:
+        return None
+    disk_budget = args.disk_budget * 1e9 if args.disk_budget is not None else None
+    return RetentionPolicy(directory, keep_cycles=args.keep_cycles, disk_budget=disk_budget, wait_for=wait_for,
+                           read_length=args.read_length, keep_last_single=args.keep_last_single)
+
+
+def get_profiler(args, role, trace=False):
+    if args.profile_dir is None:
+        return None
+    units = parse_units(args.profile_units) if args.profile_units is not None else None
+    return UnitProfiler(args.profile_dir, role, units=units, every=args.profile_every, trace=trace)
+
+
 def run_sender(args):
     sender = Sender(read_length=args.read_length, input_dir=args.in_dir, output_dir=args.send_out_dir,
                     user_hostname=args.remote, key=args.key, port=args.port,
-                    n_cpus=args.n_cpus_send, do_all=args.all, do_mapped=args.mapped)
+                    n_cpus=args.n_cpus_send, do_all=args.all, do_mapped=args.mapped,
+                    compression_level=args.compression_level, retention=get_retention(args, args.send_out_dir),
+                    resume=args.resume, profiler=get_profiler(args, "sender"))
     barcodes = args.barcodes.split(',')
     cycles = [int(c) for c in args.cycle_list.split(',')]
-    sender.run(cycles=cycles, barcodes=barcodes, mode=args.format)
+    sender.run(cycles=cycles, barcodes=barcodes, mode=args.format, n_jobs=args.jobs)
 
 
 def run_receiver(args):
@@ -52,22 +77,57 @@ def run_receiver(args):
         args.command = None
     receiver = Receiver(args.command, model=args.model, read_length=args.read_length, input_dir=args.rec_in_dir,
                         output_dir=args.rec_out_dir, n_cpus=n_cpus, threshold=args.threshold,
-                        tpu_resolver=tpu_resolver)
+                        tpu_resolver=tpu_resolver, backend=args.backend, compress_output=args.compress_output,
+                        compression_level=args.compression_level, chunk_reads=args.chunk_reads,
+                        retention=get_retention(args, args.rec_in_dir,
+                                                wait_for=["refilter"] if args.wait_for_refilter else []),
+                        resume=args.resume, read_index=args.read_index,
+                        profiler=get_profiler(args, "receiver", trace=True))
     cycles = [int(c) for c in args.cycle_list.split(',')]
     barcodes = args.barcodes.split(',')
-    receiver.run(cycles=cycles, barcodes=barcodes, mode=args.format, discard_neg=args.discard_neg)
+    receiver.run(cycles=cycles, barcodes=barcodes, mode=args.format, discard_neg=args.discard_neg,
+                 prefetch=args.prefetch)
 
 
 def run_refilter(args):
     preds_input_dirs = args.preds_in_dir.split(',')
     refilterer = Refilterer(read_length=args.read_length, input_fasta_dir=args.fasta_in_dir,
                             input_npy_dirs=preds_input_dirs, output_dir=args.ref_out_dir,
-                            threshold=args.threshold)
+                            threshold=args.threshold, backend=args.backend, compress_output=args.compress_output,
+                            compression_level=args.compression_level, resume=args.resume,
+                            read_index=args.read_index, mark_done=args.mark_done)
     cycles = [int(c) for c in args.cycle_list.split(',')]
     barcodes = args.barcodes.split(',')
     refilterer.run(cycles=cycles, barcodes=barcodes, discard_neg=args.discard_neg)
 
 
+def run_query(args):
+    result = {}
+    for barcode in args.barcodes.split(','):
+        index_path = get_index_path(args.index_dir, barcode)
+        if not os.path.exists(index_path):
+            raise FileNotFoundError("No read index found for barcode {} in {}".format(barcode, args.index_dir))
+        index = ReadIndex(index_path)
+        result[barcode] = index.query(args.reads) if args.reads is not None else index.summary()
+    if args.json:
+        print(json.dumps(result))
+        return
+    for barcode, entries in result.items():
+        print("Barcode {}:".format(barcode))
+        if args.reads is not None:
+            for name, entry in entries.items():
+                if entry is None:
+                    print("{}\tnot found".format(name))
+                else:
+                    print("{}\tlatest cycle: {}\tlatest score: {:.4f}\tmax score: {:.4f}\tfirst positive cycle: {}"
+                          .format(name, entry["latest_cycle"], entry["latest"], entry["max_score"],
+                                  entry["first_positive"]))
+        else:
+            for entry in entries:
+                print("Cycle {cycle}: {positive}/{reads} positive (threshold {threshold}), {ever_positive}/{indexed} "
+                      "positive in any cycle so far".format(**entry))
+
+
 def run_local(args):
     pr = Process(target=run_receiver, args=(args,))
     pr.start()
@@ -77,15 +137,49 @@ def run_local(args):
     ps.join()
 
 
+def run_replay(args):
+    cycles = [int(c) for c in args.cycle_list.split(',')]
+    barcodes = args.barcodes.split(',')
+    if args.replay_source is None and args.cycle_time is None:
+        raise ValueError("Generated data has no recorded release times. Set the cycle time.")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if args.replay_source is None:
+            print("Generating data...")
+            source_dir = temp_dir
+            generate_sample_bams(args.generate_reads, os.path.join(source_dir, "hilive_out_cycle"), cycles=cycles,
+                                 barcodes=barcodes, length=args.read_length)
+        else:
+            source_dir = args.replay_source
+        if args.cycle_time is not None:
+            schedule = get_schedule(cycles, barcodes, args.cycle_time / args.speedup, jitter=args.jitter)
+        else:
+            schedule = get_recorded_schedule(source_dir, cycles, barcodes, speedup=args.speedup)
+        replayer = Replayer(source_dir, args.in_dir, schedule,
+                            manifests={"sender": get_manifest_path(args.send_out_dir, "sender"),
+                                       "receiver": get_manifest_path(args.rec_out_dir, "receiver")})
+        pl = Process(target=run_local, args=(args,))
+        pl.start()
+        replayer.run(is_alive=pl.is_alive)
+        pl.join()
+    replayer.report(args.replay_report if args.replay_report is not None
+                    else os.path.join(args.rec_out_dir, "deepac-live_replay_latency.tsv"))
+
+
 def add_base_parser(bparser):
     bparser.add_argument('-l', '--read-length', dest='read_length', type=int, required=True,
                          help='Expected read length')
     bparser.add_argument('-s', '--seq-cycles', dest='cycle_list', required=True,
                          help='Comma-separated list of sequencing cycles to analyze.')
-    bparser.add_argument('-f', '--format', default="bam",
-                         help='Format of temp files. bam or fasta.')
+    bparser.add_argument('-f', '--format', default="bam", choices=["bam", "cram", "fasta", "fasta.gz"],
+                         help='Format of temp files. bam, cram, fasta or fasta.gz (bgzip-compressed).')
+    bparser.add_argument('-L', '--compression-level', dest='compression_level', type=int, choices=range(10),
+                         help='Compression level (0-9) of temp files and compressed outputs. '
+                              'Default: samtools default for temp files, 6 for outputs.')
     bparser.add_argument('-B', '--barcodes', default="undetermined",
                          help='Comma-separated list of barcodes of samples to analyze. Default: "undetermined"')
+    bparser.add_argument('-U', '--resume', action='store_true',
+                         help='Skip (cycle, barcode) units recorded as done in the manifest of the output directory, '
+                              'unless their inputs have changed.')
 
     return bparser
 
@@ -99,6 +193,19 @@ def add_receiver_parser(rparser):
                          help="Receiver output directory.")
     tparser.add_argument('-d', '--discard-neg', dest='discard_neg', action='store_true',
                          help="Don't save predictions for nonpathogenic reads.")
+    tparser.add_argument('-b', '--backend', default="fasta", choices=["fasta", "store", "both"],
+                         help='Output backend: per-cycle fasta files, a compressed result store per barcode, '
+                              'or both. Default: fasta.')
+    tparser.add_argument('-z', '--compress-output', dest='compress_output', action='store_true',
+                         help="Compress output fasta files with bgzip.")
+    tparser.add_argument('-R', '--chunk-reads', dest='chunk_reads', type=int,
+                         help="Predict in chunks of this many reads to limit memory usage. Default: all at once, "
+                              "or 65536 with -P.")
+    tparser.add_argument('-P', '--prefetch', dest='prefetch', type=int, default=0,
+                         help="Decode up to this many chunks in the background while predicting, and filter in a "
+                              "separate thread. Default: 0 (no pipelining).")
+    tparser.add_argument('-X', '--read-index', dest='read_index', action='store_true',
+                         help="Keep an index of the latest score, max score and first positive cycle of each read.")
 
     return tparser
 
@@ -126,12 +233,28 @@ def add_sender_parser(sparser):
     mapped_group.add_argument('-A', '--all', action='store_true', help="Analyze all reads (default: unmapped only).")
     mapped_group.add_argument('-M', '--mapped', action='store_true', help="Analyze only MAPPED reads "
                                                                           "(default: unmapped only).")
+    sparser.add_argument('-j', '--jobs', type=int, default=1,
+                         help='Number of barcodes to extract in parallel. The cores are split between the jobs. '
+                              'Default: 1.')
     sparser.add_argument('-r', '--remote', help='Remote host and path (with username).')
     sparser.add_argument('-k', '--key', help='SSH key.')
     sparser.add_argument('-p', '--port', default=22, help='Port for SFTP connection.')
     return sparser
 
 
+def add_retention_parser(rparser):
+    rparser.add_argument('-K', '--keep-cycles', dest='keep_cycles', type=int,
+                         help='Delete intermediate files of all but the last K cycles. Default: keep all.')
+    rparser.add_argument('-D', '--disk-budget', dest='disk_budget', type=float,
+                         help='Maximum size of intermediate files in GB. Old cycles are deleted when exceeded, '
+                              'and the sender waits for the receiver to catch up. Default: no limit.')
+    rparser.add_argument('-S', '--keep-last-single', dest='keep_last_single', action='store_true',
+                         help='Always keep the intermediate files of the last single-end cycle.')
+    rparser.add_argument('-W', '--wait-for-refilter', dest='wait_for_refilter', action='store_true',
+                         help="Don't delete receiver inputs before they were refiltered.")
+    return rparser
+
+
 def add_refilter_parser(rparser):
     rparser.add_argument('-t', '--threshold', dest='threshold', type=float, default=0.5,
                          help='Classification threshold.')
@@ -142,9 +265,57 @@ def add_refilter_parser(rparser):
                          help="Refilter output directory.")
     rparser.add_argument('-d', '--discard-neg', dest='discard_neg', action='store_true',
                          help="Don't save predictions for nonpathogenic reads.")
+    rparser.add_argument('-b', '--backend', default="fasta", choices=["fasta", "store", "both"],
+                         help='Output backend: per-cycle fasta files, a compressed result store per barcode, '
+                              'or both. Default: fasta.')
+    rparser.add_argument('-z', '--compress-output', dest='compress_output', action='store_true',
+                         help="Compress output fasta files with bgzip.")
+    rparser.add_argument('-X', '--read-index', dest='read_index', action='store_true',
+                         help="Keep an index of the latest score, max score and first positive cycle of each read.")
+    rparser.add_argument('-W', '--mark-done', dest='mark_done', action='store_true',
+                         help="Mark refiltered units as done for a receiver started with -W.")
     return rparser
 
 
+def add_profile_parser(pparser):
+    pparser.add_argument('-F', '--profile', dest='profile_dir',
+                         help="Profile (cycle, barcode) units and write the profiles and hot spots to this directory.")
+    pparser.add_argument('-u', '--profile-units', dest='profile_units',
+                         help="Comma-separated list of cycles or cycle:barcode pairs to profile. Default: all.")
+    pparser.add_argument('-e', '--profile-every', dest='profile_every', type=int, default=1,
+                         help="Profile only every n-th of the selected units. Default: 1.")
+    return pparser
+
+
+def add_replay_parser(rparser):
+    rparser.add_argument('-Y', '--replay-source', dest='replay_source',
+                         help="Directory of recorded HiLive outputs to replay. Default: generate random reads.")
+    rparser.add_argument('-G', '--generate-reads', dest='generate_reads', type=int, default=1024,
+                         help="Number of reads to generate if no recorded outputs are given. Default: 1024.")
+    rparser.add_argument('-T', '--cycle-time', dest='cycle_time', type=float,
+                         help="Seconds per sequencing cycle. Default: replay the modification times of the recorded "
+                              "outputs.")
+    rparser.add_argument('-J', '--jitter', type=float, default=0.0,
+                         help="Delay each cycle by a random fraction of a cycle up to this value. Default: 0.")
+    rparser.add_argument('-V', '--speedup', type=float, default=1.0,
+                         help="Replay this many times faster than the schedule. Default: 1.")
+    rparser.add_argument('-E', '--replay-report', dest='replay_report',
+                         help="Path of the latency report. Default: deepac-live_replay_latency.tsv in the receiver "
+                              "output directory.")
+    return rparser
+
+
+def add_query_parser(qparser):
+    qparser.add_argument('-O', '--index-dir', dest='index_dir', required=True,
+                         help="Receiver or refilter output directory.")
+    qparser.add_argument('-B', '--barcodes', default="undetermined",
+                         help='Comma-separated list of barcodes to query. Default: "undetermined"')
+    qparser.add_argument('-r', '--reads', nargs='+',
+                         help="Names of reads to look up. Default: print the per-cycle summary.")
+    qparser.add_argument('-j', '--json', action='store_true', help="Print the results as JSON.")
+    return qparser
+
+
 def parse():
     """Parse DeePaC-live CLI arguments."""
     parser = argparse.ArgumentParser(prog='deepac-live', description="Running DeePaC in real time.")
@@ -155,11 +326,15 @@ def parse():
     parser_sender = subparsers.add_parser('sender', help='Prepare and send data.')
     parser_sender = add_base_parser(parser_sender)
     parser_sender = add_sender_parser(parser_sender)
+    parser_sender = add_retention_parser(parser_sender)
+    parser_sender = add_profile_parser(parser_sender)
     parser_sender.set_defaults(func=run_sender)
 
     parser_receiver = subparsers.add_parser('receiver', help='Receive and analyze data.')
     parser_receiver = add_base_parser(parser_receiver)
     parser_receiver = add_receiver_parser(parser_receiver)
+    parser_receiver = add_retention_parser(parser_receiver)
+    parser_receiver = add_profile_parser(parser_receiver)
     parser_receiver.set_defaults(func=run_receiver)
 
     parser_refilter = subparsers.add_parser('refilter', help='Refilter data with ensembles or alternative thresholds.')
@@ -171,8 +346,24 @@ def parse():
     parser_local = add_base_parser(parser_local)
     parser_local = add_receiver_parser(parser_local)
     parser_local = add_sender_parser(parser_local)
+    parser_local = add_retention_parser(parser_local)
+    parser_local = add_profile_parser(parser_local)
     parser_local.set_defaults(func=run_local)
 
+    parser_replay = subparsers.add_parser('replay', help='Replay HiLive outputs in real time and measure the latency '
+                                                         'of local processing.')
+    parser_replay = add_base_parser(parser_replay)
+    parser_replay = add_receiver_parser(parser_replay)
+    parser_replay = add_sender_parser(parser_replay)
+    parser_replay = add_retention_parser(parser_replay)
+    parser_replay = add_profile_parser(parser_replay)
+    parser_replay = add_replay_parser(parser_replay)
+    parser_replay.set_defaults(func=run_replay)
+
+    parser_query = subparsers.add_parser('query', help='Query the read index of a receiver or refilter output.')
+    parser_query = add_query_parser(parser_query)
+    parser_query.set_defaults(func=run_query)
+
     parser_test = subparsers.add_parser('test', help='Test locally.')
     parser_test = add_tester_parser(parser_test)
     parser_test.add_argument('-k', '--keep', help="Don't delete previous test output.",
@@ -0,0 +1,86 @@
+import os
+import gzip
+import shutil
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# uncompressed size of a BGZF block, as in htslib
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def compress_block(data, level):
+    # zlib releases the GIL, so blocks can be deflated in parallel threads
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack("<4BI2BH2BHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord("B"), ord("C"), 2, len(cdata) + 25)
+    return header + cdata + struct.pack("<2I", zlib.crc32(data) & 0xffffffff, len(data))
+
+
+def bgzip_file(inpath, outpath=None, threads=1, level=6, remove=True):
+    """Compress a file to BGZF with multiple threads. Returns the path of the compressed file."""
+    if outpath is None:
+        outpath = inpath + ".gz"
+    start = time.time()
+    raw_size = os.stat(inpath).st_size
+    # compress a batch of blocks per thread at a time to keep the memory usage bounded
+    batch_size = 16 * max(threads, 1)
+    with open(inpath, "rb") as in_handle, open(outpath, "wb") as out_handle, \
+            ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        while True:
+            blocks = []
+            for _ in range(batch_size):
+                data = in_handle.read(BGZF_BLOCK_SIZE)
+                if len(data) == 0:
+                    break
+                blocks.append(data)
+            if len(blocks) == 0:
+                break
+            for cblock in executor.map(compress_block, blocks, [level] * len(blocks)):
+                out_handle.write(cblock)
+        out_handle.write(BGZF_EOF)
+    if remove:
+        os.remove(inpath)
+    report_compression(outpath, time.time() - start, raw_size=raw_size)
+    return outpath
+
+
+def gunzip_file(inpath, outpath=None):
+    """Decompress a gzip or BGZF file. Returns the path of the decompressed file."""
+    if outpath is None:
+        outpath = os.path.splitext(inpath)[0]
+    with gzip.open(inpath, "rb") as in_handle, open(outpath, "wb") as out_handle:
+        shutil.copyfileobj(in_handle, out_handle, 1024 * 1024)
+    return outpath
+
+
+def bgzf_raw_size(path):
+    """Sum up the uncompressed sizes of all BGZF blocks in a file without decompressing it.
+    Returns None if the file is not BGZF compressed."""
+    raw_size = 0
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(18)
+            if len(header) == 0:
+                return raw_size
+            if len(header) < 18 or header[:4] != b"\x1f\x8b\x08\x04" or header[12:14] != b"BC":
+                return None
+            block_size = struct.unpack("<H", header[16:18])[0] + 1
+            f.seek(block_size - 18 - 4, os.SEEK_CUR)
+            raw_size = raw_size + struct.unpack("<I", f.read(4))[0]
+
+
+def report_compression(path, elapsed, raw_size=None):
+    size = os.stat(path).st_size
+    if raw_size is None:
+        raw_size = bgzf_raw_size(path)
+    throughput = (raw_size if raw_size is not None else size) / 1e6 / max(elapsed, 1e-9)
+    if raw_size is not None and size > 0:
+        print("Wrote {name}: {size:.2f} MB in {elapsed:.2f} s ({throughput:.1f} MB/s, "
+              "compression ratio {ratio:.2f}).".format(name=os.path.basename(path), size=size / 1e6, elapsed=elapsed,
+                                                      throughput=throughput, ratio=raw_size / size))
+    else:
+        print("Wrote {name}: {size:.2f} MB in {elapsed:.2f} s ({throughput:.1f} MB/s).".format(
+            name=os.path.basename(path), size=size / 1e6, elapsed=elapsed, throughput=throughput))
@@ -0,0 +1,115 @@
+import os
+import itertools
+import sqlite3
+import numpy as np
+from deepaclive.store import iter_titles
+
+
+def get_index_path(output_dir, barcode):
+    return os.path.join(output_dir, "hilive_out_{}_index.sqlite".format(barcode))
+
+
+class ReadIndex:
+    """Incremental index of the pathogenic potential of each read of a single barcode.
+
+    For each read (or read pair), the index keeps the score of the latest cycle, the maximum score over all cycles and
+    the first cycle in which it was classified as positive. The index is updated in place as each cycle finishes, and
+    per-cycle totals are stored alongside, so that reads and summaries are looked up by key instead of rescanning the
+    outputs. The database runs in write-ahead log mode, so readers can poll it while a run is in progress.
+    """
+    def __init__(self, path, threshold=0.5, timeout=60):
+        self.path = os.path.abspath(os.path.realpath(os.path.expanduser(path)))
+        self.threshold = threshold
+        self.timeout = timeout
+
+    def __connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS reads (name TEXT PRIMARY KEY, latest_cycle INTEGER, latest REAL, "
+                     "max_score REAL, first_positive INTEGER)")
+        conn.execute("CREATE TABLE IF NOT EXISTS cycles (cycle INTEGER PRIMARY KEY, threshold REAL, reads INTEGER, "
+                     "positive INTEGER, indexed INTEGER, ever_positive INTEGER)")
+        return conn
+
+    def update(self, cycle, inpath_fasta_1, preds_npy_1, inpath_fasta_2=None, preds_npy_2=None, chunk_size=65536):
+        if os.path.exists(inpath_fasta_1) and os.stat(inpath_fasta_1).st_size != 0:
+            y_pred_1 = np.load(preds_npy_1, mmap_mode='r').reshape(-1)
+            y_pred_2 = np.load(preds_npy_2, mmap_mode='r').reshape(-1) if inpath_fasta_2 is not None else None
+        else:
+            y_pred_1 = y_pred_2 = np.empty(0)
+        names = iter_titles(inpath_fasta_1)
+
+        conn = self.__connect()
+        try:
+            # one transaction per cycle, so readers never see a half-updated cycle
+            with conn:
+                n_reads = 0
+                n_pos = 0
+                # stream the reads in chunks to keep the memory usage bounded
+                while True:
+                    chunk = list(itertools.islice(names, chunk_size))
+                    if len(chunk) == 0:
+                        break
+                    if n_reads + len(chunk) > y_pred_1.shape[0]:
+                        raise ValueError("Found {} predictions for more reads in {}".format(y_pred_1.shape[0],
+                                                                                           inpath_fasta_1))
+                    scores = y_pred_1[n_reads:n_reads + len(chunk)].astype(np.float64)
+                    if y_pred_2 is not None:
+                        # classify pairs by the mean of both mates, as in filter_paired_fasta
+                        scores = (scores + y_pred_2[n_reads:n_reads + len(chunk)]) / 2
+                    positive = scores > self.threshold
+                    self.__upsert(conn, cycle, chunk, scores, positive)
+                    n_reads = n_reads + len(chunk)
+                    n_pos = n_pos + int(np.sum(positive))
+                if n_reads != y_pred_1.shape[0]:
+                    raise ValueError("Found {} predictions for {} reads in {}".format(y_pred_1.shape[0], n_reads,
+                                                                                     inpath_fasta_1))
+                indexed = conn.execute("SELECT COUNT(*) FROM reads").fetchone()[0]
+                ever_positive = conn.execute("SELECT COUNT(*) FROM reads "
+                                             "WHERE first_positive IS NOT NULL").fetchone()[0]
+                conn.execute("INSERT OR REPLACE INTO cycles VALUES (?, ?, ?, ?, ?, ?)",
+                             (cycle, self.threshold, n_reads, n_pos, indexed, ever_positive))
+        finally:
+            conn.close()
+
+    @staticmethod
+    def __upsert(conn, cycle, names, scores, positive):
+        rows = ((name, cycle, float(score), float(score), cycle if pos else None)
+                for name, score, pos in zip(names, scores, positive))
+        # a cycle processed again (e.g. after a restart) does not overwrite the scores of later cycles
+        conn.executemany(
+            "INSERT INTO reads (name, latest_cycle, latest, max_score, first_positive) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET "
+            "latest = CASE WHEN excluded.latest_cycle >= latest_cycle THEN excluded.latest ELSE latest END, "
+            "latest_cycle = MAX(latest_cycle, excluded.latest_cycle), "
+            "max_score = MAX(max_score, excluded.max_score), "
+            "first_positive = CASE WHEN first_positive IS NULL THEN excluded.first_positive "
+            "WHEN excluded.first_positive IS NULL THEN first_positive "
+            "ELSE MIN(first_positive, excluded.first_positive) END", rows)
+
+    def query(self, names):
+        """Look up reads by name. Returns a dict of name to a dict with the keys latest_cycle, latest, max_score and
+        first_positive, or None for reads not in the index."""
+        conn = self.__connect()
+        try:
+            result = {}
+            for name in names:
+                row = conn.execute("SELECT latest_cycle, latest, max_score, first_positive FROM reads WHERE name = ?",
+                                   (name,)).fetchone()
+                result[name] = None if row is None else dict(zip(("latest_cycle", "latest", "max_score",
+                                                                  "first_positive"), row))
+            return result
+        finally:
+            conn.close()
+
+    def summary(self):
+        """Get the totals recorded after each cycle: reads and positive reads in the cycle, reads indexed so far and
+        reads classified as positive in any cycle so far."""
+        conn = self.__connect()
+        try:
+            rows = conn.execute("SELECT cycle, threshold, reads, positive, indexed, ever_positive FROM cycles "
+                                "ORDER BY cycle").fetchall()
+        finally:
+            conn.close()
+        return [dict(zip(("cycle", "threshold", "reads", "positive", "indexed", "ever_positive"), row))
+                for row in rows]
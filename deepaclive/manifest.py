@@ -0,0 +1,87 @@
+import os
+import json
+import hashlib
+import threading
+
+
+def get_manifest_path(output_dir, role):
+    return os.path.join(output_dir, "deepac-live_{}_manifest.json".format(role))
+
+
+def get_checksum(path, block_size=1024 * 1024):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def get_fingerprint(path, checksum=False):
+    stat = os.stat(path)
+    fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime}
+    if checksum:
+        fingerprint["sha256"] = get_checksum(path)
+    return fingerprint
+
+
+class Manifest:
+    """On-disk record of the (cycle, barcode) units completed by a role, with fingerprints of their inputs.
+
+    The manifest is rewritten atomically after every unit, so that a restarted role can skip the units it has
+    already completed. An input is considered unchanged if its size and modification time match, or else if its
+    checksum does. Reading the whole input for a checksum is slow, so checksums are only recorded with checksums set,
+    e.g. when resuming, and inputs without a recorded checksum only count as unchanged if their modification time
+    matches. Inputs deleted in the meantime (e.g. by a retention policy) do not invalidate a unit.
+    """
+    def __init__(self, path, checksums=False):
+        self.path = os.path.abspath(os.path.realpath(os.path.expanduser(path)))
+        self.checksums = checksums
+        self.units = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.units = json.load(f)
+        # units may be checked and completed from different threads
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # locks cannot be pickled, e.g. when the owner is sent to a worker process
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(c, barcode):
+        return "{}:{}".format(c, barcode)
+
+    def is_done(self, c, barcode):
+        with self.lock:
+            entry = self.units.get(self.get_key(c, barcode))
+        if entry is None:
+            return False
+        for path, fingerprint in entry.items():
+            if not os.path.exists(path):
+                continue
+            stat = os.stat(path)
+            if stat.st_size == fingerprint["size"] and stat.st_mtime == fingerprint["mtime"]:
+                continue
+            if stat.st_size != fingerprint["size"] or "sha256" not in fingerprint:
+                return False
+            if get_checksum(path) != fingerprint["sha256"]:
+                return False
+        return True
+
+    def mark_done(self, c, barcode, inputs):
+        entry = {os.path.abspath(p): get_fingerprint(p, self.checksums) for p in inputs
+                 if len(p) > 0 and os.path.exists(p)}
+        with self.lock:
+            self.units[self.get_key(c, barcode)] = entry
+            temp_path = "{}.tmp".format(self.path)
+            with open(temp_path, 'w') as f:
+                json.dump(self.units, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
@@ -0,0 +1,139 @@
+import os
+import io
+import time
+import pstats
+import cProfile
+from contextlib import contextmanager
+
+
+def parse_units(spec):
+    """Parse a comma-separated list of cycles and cycle:barcode pairs."""
+    units = []
+    for entry in spec.split(','):
+        if ":" in entry:
+            c, barcode = entry.split(":", 1)
+            units.append((int(c), barcode))
+        else:
+            units.append(int(entry))
+    return units
+
+
+@contextmanager
+def null_context():
+    # contextlib.nullcontext needs Python 3.7
+    yield
+
+
+def write_atomic(path, text):
+    # other processes may read the file at any time
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(temp_path, 'w') as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+
+def format_stats(stats, top):
+    out = io.StringIO()
+    stats.stream = out
+    out.write("Top {} functions by own time:\n".format(top))
+    stats.sort_stats("tottime").print_stats(top)
+    out.write("Top {} functions by cumulative time:\n".format(top))
+    stats.sort_stats("cumulative").print_stats(top)
+    return out.getvalue()
+
+
+class UnitProfiler:
+    """Profile sampled (cycle, barcode) units of a role with cProfile and, optionally, the TensorFlow profiler.
+
+    Only the units listed in units (cycles or (cycle, barcode) pairs; all units by default) are selected, and only
+    every n-th selected unit is profiled, so that profiling a production run costs little. For each profiled unit, the
+    raw profile, a summary of its hot spots and, with trace, a TensorFlow trace are written to the profile directory.
+    A summary of the hot spots of all profiled units of the role is kept in memory and written after each unit.
+    Worker processes should stop their units without summarizing them and let the parent add their profiles.
+    """
+    def __init__(self, profile_dir, role, units=None, every=1, top=25, trace=False):
+        self.profile_dir = os.path.abspath(os.path.realpath(os.path.expanduser(profile_dir)))
+        if not os.path.isdir(self.profile_dir):
+            os.makedirs(self.profile_dir, exist_ok=True)
+        self.role = role
+        self.units = units
+        self.every = max(every, 1)
+        self.top = top
+        self.trace = trace
+        self.n_selected = 0
+        self.current = None
+        self.summary = None
+        self.n_summarized = 0
+
+    def get_prefix(self, c, barcode):
+        return os.path.join(self.profile_dir, "{}_cycle{}_{}".format(self.role, c, barcode))
+
+    def sample(self, c, barcode):
+        """Decide whether to profile a unit. Call once per unit."""
+        if self.units is not None and c not in self.units and (c, barcode) not in self.units:
+            return False
+        self.n_selected = self.n_selected + 1
+        return (self.n_selected - 1) % self.every == 0
+
+    def start(self, c, barcode):
+        profile = cProfile.Profile()
+        if self.trace:
+            import tensorflow as tf
+            tf.profiler.experimental.start("{}_trace".format(self.get_prefix(c, barcode)))
+        self.current = (c, barcode, profile, time.time())
+        profile.enable()
+
+    def stop(self, summarize=True):
+        if self.current is None:
+            return
+        c, barcode, profile, start = self.current
+        profile.disable()
+        if self.trace:
+            import tensorflow as tf
+            tf.profiler.experimental.stop()
+        self.current = None
+        elapsed = time.time() - start
+
+        prefix = self.get_prefix(c, barcode)
+        temp_path = "{}.prof.{}.tmp".format(prefix, os.getpid())
+        profile.dump_stats(temp_path)
+        os.replace(temp_path, "{}.prof".format(prefix))
+        stats = pstats.Stats(profile)
+        write_atomic("{}_hotspots.txt".format(prefix), "Cycle {}, barcode {}: {:.2f} s\n{}".format(
+            c, barcode, elapsed, format_stats(stats, self.top)))
+        if summarize:
+            self.add_to_summary(profile)
+        hotspot = max(stats.stats.items(), key=lambda item: item[1][2], default=None)
+        if hotspot is not None:
+            (filename, line, name), (cc, nc, tottime, cumtime, callers) = hotspot
+            print("Profiled cycle {}, barcode {} in {:.2f} s. Top hot spot: {} ({}:{}), {:.2f} s.".format(
+                c, barcode, elapsed, name, os.path.basename(filename), line, tottime))
+
+    def add_to_summary(self, profile):
+        """Add a profile or a dumped profile of a unit to the summary and write it."""
+        if self.summary is None:
+            self.summary = pstats.Stats(profile)
+        else:
+            self.summary.add(profile)
+        # the header would list every dumped profile
+        self.summary.files = []
+        self.n_summarized = self.n_summarized + 1
+        self.write_summary()
+
+    def add_unit(self, c, barcode):
+        """Add a unit profiled by a worker process to the summary."""
+        self.add_to_summary("{}.prof".format(self.get_prefix(c, barcode)))
+
+    def write_summary(self):
+        if self.summary is None:
+            return
+        write_atomic(os.path.join(self.profile_dir, "{}_hotspots.txt".format(self.role)),
+                     "{} profiled units\n{}".format(self.n_summarized, format_stats(self.summary, self.top)))
+
+    @contextmanager
+    def unit(self, c, barcode, summarize=True):
+        self.start(c, barcode)
+        try:
+            yield
+        finally:
+            self.stop(summarize)
@@ -2,13 +2,28 @@ import os
 import fnmatch
 import importlib
 from deepac.predict import predict_fasta, filter_paired_fasta
+from deepac.preproc import tokenize
 from deepac.builtin_loading import BuiltinLoader
 import tensorflow as tf
 from tensorflow.keras.models import load_model
 import time
 import pysam
 import numpy as np
-from multiprocessing import cpu_count
+import itertools
+import shutil
+import queue
+import threading
+from functools import partial
+from multiprocessing import cpu_count, Pool
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from deepaclive.store import ResultStore, get_store_path
+from deepaclive.index import ReadIndex, get_index_path
+from deepaclive.compression import bgzip_file, gunzip_file
+from deepaclive.manifest import Manifest, get_manifest_path
+from deepaclive.profiling import null_context
+
+# chunk size of the pipelined receiver without -R; each queued chunk holds this many encoded reads
+PIPELINE_CHUNK_READS = 65536
 
 
 def get_builtin(deepac_command):
@@ -52,10 +67,75 @@ def get_builtin(deepac_command):
     return builtin_configs, builtin_weights
 
 
+def put_until_stopped(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def get_until_stopped(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=1)
+        except queue.Empty:
+            pass
+    return None
+
+
+def count_fasta_records(inpath_fasta):
+    n_records = 0
+    with open(inpath_fasta, 'rb') as in_handle:
+        for line in in_handle:
+            if line.startswith(b'>'):
+                n_records = n_records + 1
+    return n_records
+
+
+def read_fasta_record_chunks(inpath_fasta, chunk_size):
+    with open(inpath_fasta) as in_handle:
+        records = SimpleFastaParser(in_handle)
+        while True:
+            chunk = list(itertools.islice(records, chunk_size))
+            if len(chunk) == 0:
+                break
+            yield chunk
+
+
+def read_fasta_chunks(inpath_fasta, chunk_size):
+    for chunk in read_fasta_record_chunks(inpath_fasta, chunk_size):
+        yield [seq for (title, seq) in chunk]
+
+
+def append_file(inpath, outpath):
+    if os.path.exists(inpath):
+        with open(inpath, 'rb') as in_handle, open(outpath, 'ab') as out_handle:
+            shutil.copyfileobj(in_handle, out_handle, 1024 * 1024)
+        os.remove(inpath)
+
+
+def append_mates(inpath, outpath_1, outpath_2):
+    # filter_paired_fasta writes the selected pairs' first mates, then their second mates
+    if os.path.exists(inpath):
+        with open(inpath) as in_handle:
+            records = list(SimpleFastaParser(in_handle))
+        n_pairs = len(records) // 2
+        for outpath, mates in ((outpath_1, records[:n_pairs]), (outpath_2, records[n_pairs:])):
+            with open(outpath, 'a') as out_handle:
+                out_handle.writelines(">{}\n{}\n".format(title, seq) for (title, seq) in mates)
+        os.remove(inpath)
+
+
 class Receiver:
     def __init__(self, deepac_command, model, read_length, input_dir, output_dir, n_cpus=None, threshold=0.5,
-                 tpu_resolver=None):
+                 tpu_resolver=None, backend="fasta", compress_output=False, compression_level=None, chunk_reads=None,
+                 retention=None, resume=False, read_index=False, profiler=None):
         print("Setting up the receiver...")
+        if backend not in ("fasta", "store", "both"):
+            raise ValueError("Unrecognized output backend: {}".format(backend))
 
         self.input_dir = os.path.abspath(os.path.realpath(os.path.expanduser(input_dir)))
         self.output_dir = os.path.abspath(os.path.realpath(os.path.expanduser(output_dir)))
@@ -88,93 +168,240 @@ class Receiver:
         self.threshold = threshold
         self.read_length = read_length
         self.cores = n_cpus if n_cpus is not None else cpu_count()
+        self.backend = backend
+        self.stores = {}
+        self.read_index = read_index
+        self.indices = {}
+        self.compress_output = compress_output
+        self.compression_level = compression_level if compression_level is not None else 6
+        self.chunk_reads = chunk_reads
+        self.retention = retention
+        self.resume = resume
+        # checksums are only needed to recognize unchanged inputs when resuming
+        self.manifest = Manifest(get_manifest_path(self.output_dir, "receiver"), checksums=resume)
+        self.profiler = profiler
 
         print("Receiver ready.")
 
-    def do_pred_bam(self, inpath_bam, outpath_npy):
-        if os.stat(inpath_bam).st_size != 0:
-            pre, ext = os.path.splitext(inpath_bam)
+    def do_decode(self, inpath, mode):
+        if mode == "bam" or mode == "cram":
+            pre, ext = os.path.splitext(inpath)
             temp_fasta = "{}.fasta".format(pre)
             # create the file upfront, so pysam can open it
             with open(temp_fasta, 'w') as fp:
                 pass
-            pysam.fasta("-@", str(self.cores - 1), inpath_bam, save_stdout=temp_fasta)
-            self.do_pred_fasta(temp_fasta, outpath_npy)
+            if os.stat(inpath).st_size != 0:
+                pysam.fasta("-@", str(self.cores - 1), inpath, save_stdout=temp_fasta)
+            return temp_fasta
+        elif mode == "fasta.gz":
+            return gunzip_file(inpath)
         else:
-            np.save(outpath_npy, np.empty(0))
+            # mode == "fasta"
+            return inpath
+
+    def do_pred_bam(self, inpath_bam, outpath_npy):
+        self.do_pred(inpath_bam, outpath_npy, "bam")
+
+    def get_encoder(self, datatype='int32'):
+        # encode reads as deepac's predict_fasta does, trimmed or padded to the input length of the model
+        input_layer_id = [idx for idx, layer in enumerate(self.model.layers) if "Input" in str(layer)][0]
+        model_read_length = self.model.get_layer(index=input_layer_id).get_output_at(0).shape[1]
+        tokenizer = tf.keras.preprocessing.text.Tokenizer(char_level=True)
+        tokenizer.fit_on_texts("ACGT")
+        return partial(tokenize, tokenizer=tokenizer, datatype=datatype, read_length=model_read_length)
 
     def do_pred_fasta(self, inpath_fasta, outpath_npy):
         if os.stat(inpath_fasta).st_size != 0:
-            predict_fasta(model=self.model, input_fasta=inpath_fasta, output=outpath_npy, token_cores=self.cores)
+            if self.chunk_reads is not None:
+                self.do_pred_fasta_chunked(inpath_fasta, outpath_npy)
+            else:
+                predict_fasta(model=self.model, input_fasta=inpath_fasta, output=outpath_npy, token_cores=self.cores)
         else:
             np.save(outpath_npy, np.empty(0))
 
+    def do_pred_fasta_chunked(self, inpath_fasta, outpath_npy, datatype='int32', batch_size=512):
+        # peak memory is bound by the chunk size, not by the number of reads in the file
+        start = time.time()
+        encode = self.get_encoder(datatype)
+
+        n_reads = count_fasta_records(inpath_fasta)
+        y_pred = np.lib.format.open_memmap(outpath_npy, mode='w+', dtype=np.float32,
+                                           shape=(n_reads, self.model.output.shape[1]))
+        n_done = 0
+        with Pool(processes=self.cores) as p:
+            for chunk in read_fasta_chunks(inpath_fasta, self.chunk_reads):
+                x_data = np.asarray(p.map(encode, chunk), dtype=datatype)
+                y_pred[n_done:n_done + x_data.shape[0]] = self.model.predict(x_data, batch_size=batch_size)
+                n_done = n_done + x_data.shape[0]
+        y_pred.flush()
+        del y_pred
+        end = time.time()
+        print("Preprocessing & predictions for {} reads in chunks of {} done in {} s".format(n_done, self.chunk_reads,
+                                                                                            end - start))
+
     def do_filter_fasta(self, inpath_fasta, preds_npy, out_fasta_pos, out_fasta_neg):
-        if os.path.exists(inpath_fasta) and os.stat(inpath_fasta).st_size != 0:
+        if self.chunk_reads is not None:
+            self.do_filter_chunked([inpath_fasta], [preds_npy], out_fasta_pos, out_fasta_neg)
+        elif os.path.exists(inpath_fasta) and os.stat(inpath_fasta).st_size != 0:
             filter_paired_fasta(input_fasta_1=inpath_fasta, predictions_1=preds_npy, output_pos=out_fasta_pos,
                                 output_neg=out_fasta_neg, threshold=self.threshold, print_potentials=True)
 
     def do_filter_paired_fasta(self, inpath_fasta_1, inpath_fasta_2, preds_npy_1, preds_npy_2, out_fasta_pos,
                                out_fasta_neg=None):
-        if os.path.exists(inpath_fasta_1) and os.stat(inpath_fasta_1).st_size != 0:
+        if self.chunk_reads is not None:
+            self.do_filter_chunked([inpath_fasta_1, inpath_fasta_2], [preds_npy_1, preds_npy_2], out_fasta_pos,
+                                   out_fasta_neg)
+        elif os.path.exists(inpath_fasta_1) and os.stat(inpath_fasta_1).st_size != 0:
             filter_paired_fasta(input_fasta_1=inpath_fasta_1, predictions_1=preds_npy_1, output_pos=out_fasta_pos,
                                 input_fasta_2=inpath_fasta_2, predictions_2=preds_npy_2, output_neg=out_fasta_neg,
                                 threshold=self.threshold, print_potentials=True)
 
-    def run(self, cycles, barcodes, mode="bam", discard_neg=False):
+    def do_filter_chunked(self, inpath_fastas, preds_npys, out_fasta_pos, out_fasta_neg=None):
+        # filter_paired_fasta loads all reads at once, so feed it one chunk of reads (and predictions) at a time
+        if not os.path.exists(inpath_fastas[0]) or os.stat(inpath_fastas[0]).st_size == 0:
+            return
+        for outpath in (out_fasta_pos, out_fasta_neg):
+            if outpath is not None:
+                with open(outpath, 'w') as fp:
+                    pass
+        prefix = "{}.chunk".format(os.path.splitext(out_fasta_pos)[0])
+        chunk_fastas = ["{}_{}.fasta".format(prefix, m) for m in range(1, len(inpath_fastas) + 1)]
+        chunk_npys = ["{}_{}.npy".format(prefix, m) for m in range(1, len(inpath_fastas) + 1)]
+        chunk_pos = "{}_pos.fasta".format(prefix)
+        chunk_neg = "{}_neg.fasta".format(prefix) if out_fasta_neg is not None else None
+        # collect the second mates separately to write them after all first mates, as in unchunked outputs
+        mates_pos = "{}_pos_2.fasta".format(prefix)
+        mates_neg = "{}_neg_2.fasta".format(prefix)
+        y_preds = [np.load(preds_npy, mmap_mode='r') for preds_npy in preds_npys]
+        readers = [read_fasta_record_chunks(inpath_fasta, self.chunk_reads) for inpath_fasta in inpath_fastas]
+        offset = 0
+        for chunks in zip(*readers):
+            for chunk, y_pred, chunk_fasta, chunk_npy in zip(chunks, y_preds, chunk_fastas, chunk_npys):
+                with open(chunk_fasta, 'w') as out_handle:
+                    out_handle.writelines(">{}\n{}\n".format(title, seq) for (title, seq) in chunk)
+                np.save(chunk_npy, y_pred[offset:offset + len(chunk)])
+            filter_paired_fasta(input_fasta_1=chunk_fastas[0], predictions_1=chunk_npys[0], output_pos=chunk_pos,
+                                input_fasta_2=chunk_fastas[1] if len(chunk_fastas) > 1 else None,
+                                predictions_2=chunk_npys[1] if len(chunk_npys) > 1 else None, output_neg=chunk_neg,
+                                threshold=self.threshold, print_potentials=True)
+            if len(inpath_fastas) > 1:
+                append_mates(chunk_pos, out_fasta_pos, mates_pos)
+                if chunk_neg is not None:
+                    append_mates(chunk_neg, out_fasta_neg, mates_neg)
+            else:
+                append_file(chunk_pos, out_fasta_pos)
+                if chunk_neg is not None:
+                    append_file(chunk_neg, out_fasta_neg)
+            offset = offset + len(chunks[0])
+        del y_preds
+        append_file(mates_pos, out_fasta_pos)
+        if out_fasta_neg is not None:
+            append_file(mates_neg, out_fasta_neg)
+        for path in chunk_fastas + chunk_npys:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def do_compress_outputs(self, *paths):
+        for path in paths:
+            if path is not None and os.path.exists(path):
+                bgzip_file(path, threads=self.cores, level=self.compression_level)
+
+    def do_pred(self, inpath, outpath_npy, mode):
+        self.do_pred_fasta(self.do_decode(inpath, mode), outpath_npy)
+
+    def do_store(self, c, barcode, inpath_fasta_1, preds_npy_1, inpath_fasta_2=None, preds_npy_2=None):
+        if barcode not in self.stores:
+            self.stores[barcode] = ResultStore(get_store_path(self.output_dir, barcode))
+        self.stores[barcode].append(c, inpath_fasta_1, preds_npy_1, inpath_fasta_2, preds_npy_2)
+
+    def do_index(self, c, barcode, inpath_fasta_1, preds_npy_1, inpath_fasta_2=None, preds_npy_2=None):
+        if barcode not in self.indices:
+            self.indices[barcode] = ReadIndex(get_index_path(self.output_dir, barcode), threshold=self.threshold)
+        self.indices[barcode].update(c, inpath_fasta_1, preds_npy_1, inpath_fasta_2, preds_npy_2)
+
+    def get_unit(self, c, barcode, mode, discard_neg=False):
+        single = c <= self.read_length
+        mates = [1] if single else [1, 2]
+        prefix = "hilive_out_cycle{}_{}".format(c, barcode)
+        unit = {"cycle": c, "barcode": barcode, "single": single,
+                "inputs": [os.path.join(self.input_dir, "{}_deepac_{}.{}".format(prefix, m, mode)) for m in mates],
+                # bam, cram and fasta.gz inputs are converted to plain fasta files before predicting
+                "fastas": [os.path.join(self.input_dir, "{}_deepac_{}.fasta".format(prefix, m)) for m in mates],
+                "npys": [os.path.join(self.output_dir, "{}_deepac_{}.npy".format(prefix, m)) for m in mates],
+                # decompressed copies of fasta.gz inputs are deleted once the unit is done
+                "temp_fastas": [],
+                "out_fasta_pos": os.path.join(self.output_dir, "{}_predicted_pos.fasta".format(prefix))}
+        if mode == "fasta.gz":
+            unit["temp_fastas"] = unit["fastas"]
+        if discard_neg:
+            unit["out_fasta_neg"] = None
+        else:
+            unit["out_fasta_neg"] = os.path.join(self.output_dir, "{}_predicted_neg.fasta".format(prefix))
+        return unit
+
+    def do_postprocess(self, unit):
+        c, barcode = unit["cycle"], unit["barcode"]
+        if unit["single"]:
+            if self.backend != "store":
+                self.do_filter_fasta(unit["fastas"][0], unit["npys"][0], unit["out_fasta_pos"], unit["out_fasta_neg"])
+            if self.backend != "fasta":
+                self.do_store(c, barcode, unit["fastas"][0], unit["npys"][0])
+            if self.read_index:
+                self.do_index(c, barcode, unit["fastas"][0], unit["npys"][0])
+        else:
+            if self.backend != "store":
+                self.do_filter_paired_fasta(unit["fastas"][0], unit["fastas"][1], unit["npys"][0], unit["npys"][1],
+                                            unit["out_fasta_pos"], unit["out_fasta_neg"])
+            if self.backend != "fasta":
+                self.do_store(c, barcode, unit["fastas"][0], unit["npys"][0], unit["fastas"][1], unit["npys"][1])
+            if self.read_index:
+                self.do_index(c, barcode, unit["fastas"][0], unit["npys"][0], unit["fastas"][1], unit["npys"][1])
+        if self.compress_output:
+            self.do_compress_outputs(unit["out_fasta_pos"], unit["out_fasta_neg"])
+
+    def is_done(self, c, barcode):
+        if self.resume and self.manifest.is_done(c, barcode):
+            print("Skipping cycle {}, barcode {}: already done.".format(c, barcode))
+            return True
+        return False
+
+    def is_profiled(self, c, barcode):
+        return self.profiler is not None and self.profiler.sample(c, barcode)
+
+    def do_release(self, unit):
+        self.manifest.mark_done(unit["cycle"], unit["barcode"], unit["inputs"])
+        for temp_fasta in unit["temp_fastas"]:
+            if os.path.exists(temp_fasta):
+                os.remove(temp_fasta)
+        if self.retention is not None:
+            self.retention.register(unit["cycle"], unit["barcode"], unit["inputs"] + unit["fastas"])
+            self.retention.cleanup()
+
+    def run(self, cycles, barcodes, mode="bam", discard_neg=False, prefetch=0):
+        if mode not in ("bam", "cram", "fasta", "fasta.gz"):
+            raise ValueError("Unrecognized sender format: {}".format(mode))
+        if prefetch > 0:
+            self.run_pipelined(cycles, barcodes, mode, discard_neg, prefetch)
+            return
         # copy by value
         cycles_todo = cycles[:]
-        if mode != "bam" and mode != "fasta":
-            raise ValueError("Unrecognized sender format: {}".format(mode))
 
         while len(cycles_todo) > 0:
             c = cycles_todo[0]
-            single = c <= self.read_length
             barcodes_todo = barcodes[:]
             while len(barcodes_todo) > 0:
                 barcode = barcodes_todo[0]
-                inpath_bam_1 = os.path.join(self.input_dir, "hilive_out_cycle{}_{}_deepac_1.bam".format(c, barcode))
-                inpath_bam_2 = os.path.join(self.input_dir, "hilive_out_cycle{}_{}_deepac_2.bam".format(c, barcode))
-                inpath_fasta_1 = os.path.join(self.input_dir, "hilive_out_cycle{}_{}_deepac_1.fasta".format(c, barcode))
-                inpath_fasta_2 = os.path.join(self.input_dir, "hilive_out_cycle{}_{}_deepac_2.fasta".format(c, barcode))
-
-                if mode == "bam":
-                    single_exists = single and os.path.exists(inpath_bam_1)
-                    pair_exists = os.path.exists(inpath_bam_1) and os.path.exists(inpath_bam_2)
-                else:
-                    single_exists = single and os.path.exists(inpath_fasta_1)
-                    pair_exists = os.path.exists(inpath_fasta_1) and os.path.exists(inpath_fasta_2)
+                unit = self.get_unit(c, barcode, mode, discard_neg)
 
-                if single_exists or pair_exists:
+                if self.is_done(c, barcode):
+                    barcodes_todo.pop(0)
+                elif all([os.path.exists(i) for i in unit["inputs"]]):
                     print("Received cycle {}, barcode {}.".format(c, barcode))
-
-                    out_fasta_pos = os.path.join(self.output_dir,
-                                                 "hilive_out_cycle{}_{}_predicted_pos.fasta".format(c, barcode))
-                    if discard_neg:
-                        out_fasta_neg = None
-                    else:
-                        out_fasta_neg = os.path.join(self.output_dir,
-                                                     "hilive_out_cycle{}_{}_predicted_neg.fasta".format(c, barcode))
-                    outpath_npy_1 = os.path.join(self.output_dir,
-                                                 "hilive_out_cycle{}_{}_deepac_1.npy".format(c, barcode))
-                    if mode == "bam":
-                        self.do_pred_bam(inpath_bam_1, outpath_npy_1)
-                    else:
-                        # mode == "fasta"
-                        self.do_pred_fasta(inpath_fasta_1, outpath_npy_1)
-
-                    if single:
-                        self.do_filter_fasta(inpath_fasta_1, outpath_npy_1, out_fasta_pos, out_fasta_neg)
-                    else:
-                        outpath_npy_2 = os.path.join(self.output_dir,
-                                                     "hilive_out_cycle{}_{}_deepac_2.npy".format(c, barcode))
-                        if mode == "bam":
-                            self.do_pred_bam(inpath_bam_2, outpath_npy_2)
-                        else:
-                            self.do_pred_fasta(inpath_fasta_2, outpath_npy_2)
-
-                        self.do_filter_paired_fasta(inpath_fasta_1, inpath_fasta_2, outpath_npy_1, outpath_npy_2,
-                                                    out_fasta_pos, out_fasta_neg)
+                    with self.profiler.unit(c, barcode) if self.is_profiled(c, barcode) else null_context():
+                        for inpath, outpath_npy in zip(unit["inputs"], unit["npys"]):
+                            self.do_pred(inpath, outpath_npy, mode)
+                        self.do_postprocess(unit)
+                    self.do_release(unit)
                     barcodes_todo.pop(0)
                 else:
                     time.sleep(1)
@@ -184,6 +411,129 @@ class Receiver:
             else:
                 print("All predictions done")
 
+    def run_decoder(self, cycles, barcodes, mode, discard_neg, pool, decoded, stop, datatype='int32'):
+        encode = self.get_encoder(datatype)
+
+        for c in cycles:
+            for barcode in barcodes:
+                if self.is_done(c, barcode):
+                    continue
+                unit = self.get_unit(c, barcode, mode, discard_neg)
+                while not all([os.path.exists(i) for i in unit["inputs"]]):
+                    if stop.is_set():
+                        return
+                    time.sleep(1)
+                print("Received cycle {}, barcode {}.".format(c, barcode))
+                for inpath, outpath_npy in zip(unit["inputs"], unit["npys"]):
+                    inpath_fasta = self.do_decode(inpath, mode)
+                    n_reads = count_fasta_records(inpath_fasta) if os.path.exists(inpath_fasta) else 0
+                    if n_reads == 0:
+                        put_until_stopped(decoded, {"cycle": c, "barcode": barcode, "npy": outpath_npy,
+                                                    "n_reads": 0}, stop)
+                        continue
+                    offset = 0
+                    chunk_size = self.chunk_reads if self.chunk_reads is not None else PIPELINE_CHUNK_READS
+                    for chunk in read_fasta_chunks(inpath_fasta, chunk_size):
+                        x_data = np.asarray(pool.map(encode, chunk), dtype=datatype)
+                        if not put_until_stopped(decoded, {"cycle": c, "barcode": barcode, "npy": outpath_npy,
+                                                           "n_reads": n_reads, "offset": offset, "x": x_data}, stop):
+                            return
+                        offset = offset + x_data.shape[0]
+                if not put_until_stopped(decoded, {"unit": unit}, stop):
+                    return
+        put_until_stopped(decoded, None, stop)
+
+    def run_writer(self, predicted, stop):
+        while True:
+            unit = get_until_stopped(predicted, stop)
+            if unit is None:
+                return
+            self.do_postprocess(unit)
+            self.do_release(unit)
+            print("Done cycle {}, barcode {}.".format(unit["cycle"], unit["barcode"]))
+
+    def run_pipelined(self, cycles, barcodes, mode="bam", discard_neg=False, prefetch=2, batch_size=512):
+        """Decode and encode the next units in the background while predicting the current one,
+        and filter and write the results in another thread."""
+        decoded = queue.Queue(maxsize=prefetch)
+        predicted = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+        errors = []
+
+        def run_stage(target, *args):
+            try:
+                target(*args)
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+
+        start = time.time()
+        idle_time = 0.0
+        depths_decoded = []
+        depths_predicted = []
+        # fork the workers before any threads are started
+        with Pool(processes=self.cores) as pool:
+            decoder = threading.Thread(target=run_stage, args=(self.run_decoder, cycles, barcodes, mode, discard_neg,
+                                                               pool, decoded, stop))
+            writer = threading.Thread(target=run_stage, args=(self.run_writer, predicted, stop))
+            decoder.start()
+            writer.start()
+            try:
+                y_pred = None
+                # only the inference of a unit is profiled, as decoding and writing run in other threads
+                current = None
+                while True:
+                    depths_decoded.append(decoded.qsize())
+                    wait_start = time.time()
+                    item = get_until_stopped(decoded, stop)
+                    idle_time = idle_time + time.time() - wait_start
+                    if item is None:
+                        put_until_stopped(predicted, None, stop)
+                        break
+                    if "unit" in item:
+                        if self.profiler is not None:
+                            self.profiler.stop()
+                        current = None
+                        depths_predicted.append(predicted.qsize())
+                        print("Predicted cycle {}, barcode {}. Queue depths: {} decoded chunks, {} units to write. "
+                              "Inference idle for {:.2f} s in total.".format(item["unit"]["cycle"],
+                                                                            item["unit"]["barcode"],
+                                                                            decoded.qsize(), predicted.qsize(),
+                                                                            idle_time))
+                        put_until_stopped(predicted, item["unit"], stop)
+                        continue
+                    if current is None:
+                        current = (item["cycle"], item["barcode"])
+                        if self.is_profiled(*current):
+                            self.profiler.start(*current)
+                    if item["n_reads"] == 0:
+                        np.save(item["npy"], np.empty(0))
+                    else:
+                        if item["offset"] == 0:
+                            y_pred = np.lib.format.open_memmap(item["npy"], mode='w+', dtype=np.float32,
+                                                               shape=(item["n_reads"], self.model.output.shape[1]))
+                        n_done = item["offset"] + item["x"].shape[0]
+                        y_pred[item["offset"]:n_done] = self.model.predict(item["x"], batch_size=batch_size)
+                        if n_done == item["n_reads"]:
+                            y_pred.flush()
+                            y_pred = None
+            except Exception:
+                stop.set()
+                raise
+            finally:
+                if self.profiler is not None:
+                    self.profiler.stop()
+                decoder.join()
+                writer.join()
+        if len(errors) > 0:
+            raise errors[0]
+        elapsed = time.time() - start
+        print("All predictions done in {:.2f} s. Inference busy {:.1f}% of the time. "
+              "Mean queue depths: {:.2f} decoded chunks, {:.2f} units to write.".format(
+               elapsed, 100 * (elapsed - idle_time) / max(elapsed, 1e-9),
+               np.mean(depths_decoded) if len(depths_decoded) > 0 else 0.0,
+               np.mean(depths_predicted) if len(depths_predicted) > 0 else 0.0))
+
     def refilter(self, cycles, barcodes, discard_neg=False):
         for c in cycles:
             for barcode in barcodes:
@@ -1,11 +1,21 @@
 import os
 from deepac.predict import filter_paired_fasta, ensemble
 import time
+from multiprocessing import cpu_count
+from deepaclive.store import ResultStore, get_store_path
+from deepaclive.index import ReadIndex, get_index_path
+from deepaclive.compression import bgzip_file, gunzip_file
+from deepaclive.retention import mark_done
+from deepaclive.manifest import Manifest, get_manifest_path
 
 
 class Refilterer:
-    def __init__(self, read_length, input_fasta_dir, input_npy_dirs, output_dir, threshold=0.5):
+    def __init__(self, read_length, input_fasta_dir, input_npy_dirs, output_dir, threshold=0.5, backend="fasta",
+                 compress_output=False, compression_level=None, n_cpus=None, resume=False,
+                 read_index=False, mark_done=False):
         print("Setting up the refilterer...")
+        if backend not in ("fasta", "store", "both"):
+            raise ValueError("Unrecognized output backend: {}".format(backend))
         self.input_fasta_dir = os.path.abspath(os.path.realpath(os.path.expanduser(input_fasta_dir)))
         self.input_npy_dirs = [os.path.abspath(os.path.realpath(os.path.expanduser(i))) for i in input_npy_dirs]
         self.output_dir = os.path.abspath(os.path.realpath(os.path.expanduser(output_dir)))
@@ -16,6 +26,17 @@ class Refilterer:
             os.mkdir(self.output_dir)
         self.threshold = threshold
         self.read_length = read_length
+        self.backend = backend
+        self.stores = {}
+        self.read_index = read_index
+        self.indices = {}
+        self.compress_output = compress_output
+        self.compression_level = compression_level if compression_level is not None else 6
+        self.cores = n_cpus if n_cpus is not None else cpu_count()
+        self.resume = resume
+        # checksums are only needed to recognize unchanged inputs when resuming
+        self.manifest = Manifest(get_manifest_path(self.output_dir, "refilter"), checksums=resume)
+        self.mark_done = mark_done
         print("Refilterer ready.")
 
     def do_filter_fasta(self, inpath_fasta, preds_npy, out_fasta_pos, out_fasta_neg):
@@ -30,6 +51,27 @@ class Refilterer:
                                 input_fasta_2=inpath_fasta_2, predictions_2=preds_npy_2, output_neg=out_fasta_neg,
                                 threshold=self.threshold, print_potentials=True)
 
+    def get_input_fasta(self, inpath_fasta):
+        # fall back to bgzf compressed inputs; deepac reads plain fasta only
+        if not os.path.exists(inpath_fasta) and os.path.exists(inpath_fasta + ".gz"):
+            return gunzip_file(inpath_fasta + ".gz", os.path.join(self.output_dir, os.path.basename(inpath_fasta)))
+        return inpath_fasta
+
+    def do_compress_outputs(self, *paths):
+        for path in paths:
+            if path is not None and os.path.exists(path):
+                bgzip_file(path, threads=self.cores, level=self.compression_level)
+
+    def do_store(self, c, barcode, inpath_fasta_1, preds_npy_1, inpath_fasta_2=None, preds_npy_2=None):
+        if barcode not in self.stores:
+            self.stores[barcode] = ResultStore(get_store_path(self.output_dir, barcode))
+        self.stores[barcode].append(c, inpath_fasta_1, preds_npy_1, inpath_fasta_2, preds_npy_2)
+
+    def do_index(self, c, barcode, inpath_fasta_1, preds_npy_1, inpath_fasta_2=None, preds_npy_2=None):
+        if barcode not in self.indices:
+            self.indices[barcode] = ReadIndex(get_index_path(self.output_dir, barcode), threshold=self.threshold)
+        self.indices[barcode].update(c, inpath_fasta_1, preds_npy_1, inpath_fasta_2, preds_npy_2)
+
     def run(self, cycles, barcodes, discard_neg=False):
         # copy by value
         cycles_todo = cycles[:]
@@ -53,10 +95,20 @@ class Refilterer:
                 pairs_exist = all([os.path.exists(i) for i in inpath_npys_1]) and all(
                     [os.path.exists(i) for i in inpath_npys_2])
 
-                fasta_valid_1 = os.path.exists(inpath_fasta_1) and os.stat(inpath_fasta_1).st_size != 0
-                fasta_valid_2 = os.path.exists(inpath_fasta_2) and os.stat(inpath_fasta_2).st_size != 0
-
-                if singles_exist or pairs_exist:
+                if self.resume and self.manifest.is_done(c, barcode):
+                    print("Skipping cycle {}, barcode {}: already done.".format(c, barcode))
+                    barcodes_todo.pop(0)
+                elif singles_exist or pairs_exist:
+                    inputs = inpath_npys_1 + ([] if single else inpath_npys_2)
+                    for inpath_fasta in (inpath_fasta_1,) if single else (inpath_fasta_1, inpath_fasta_2):
+                        inputs.append(inpath_fasta if os.path.exists(inpath_fasta) else inpath_fasta + ".gz")
+                    plain_fasta_1 = self.get_input_fasta(inpath_fasta_1)
+                    plain_fasta_2 = inpath_fasta_2 if single else self.get_input_fasta(inpath_fasta_2)
+                    temp_fastas = [p for p in (plain_fasta_1, plain_fasta_2)
+                                   if p not in (inpath_fasta_1, inpath_fasta_2)]
+                    inpath_fasta_1, inpath_fasta_2 = plain_fasta_1, plain_fasta_2
+                    fasta_valid_1 = os.path.exists(inpath_fasta_1) and os.stat(inpath_fasta_1).st_size != 0
+                    fasta_valid_2 = os.path.exists(inpath_fasta_2) and os.stat(inpath_fasta_2).st_size != 0
                     if (single and fasta_valid_1) or (fasta_valid_1 and fasta_valid_2):
                         print("Refiltering cycle {}, barcode {}.".format(c, barcode))
 
@@ -72,14 +124,34 @@ class Refilterer:
                         ensemble(inpath_npys_1, outpath_npy_1)
 
                         if single:
-                            self.do_filter_fasta(inpath_fasta_1, outpath_npy_1, out_fasta_pos, out_fasta_neg)
+                            if self.backend != "store":
+                                self.do_filter_fasta(inpath_fasta_1, outpath_npy_1, out_fasta_pos, out_fasta_neg)
+                            if self.backend != "fasta":
+                                self.do_store(c, barcode, inpath_fasta_1, outpath_npy_1)
+                            if self.read_index:
+                                self.do_index(c, barcode, inpath_fasta_1, outpath_npy_1)
                         else:
                             outpath_npy_2 = os.path.join(self.output_dir,
                                                          "hilive_out_cycle{}_{}_deepac_2.npy".format(c, barcode))
                             ensemble(inpath_npys_2, outpath_npy_2)
 
-                            self.do_filter_paired_fasta(inpath_fasta_1, inpath_fasta_2, outpath_npy_1, outpath_npy_2,
-                                                        out_fasta_pos, out_fasta_neg)
+                            if self.backend != "store":
+                                self.do_filter_paired_fasta(inpath_fasta_1, inpath_fasta_2, outpath_npy_1,
+                                                            outpath_npy_2, out_fasta_pos, out_fasta_neg)
+                            if self.backend != "fasta":
+                                self.do_store(c, barcode, inpath_fasta_1, outpath_npy_1, inpath_fasta_2,
+                                              outpath_npy_2)
+                            if self.read_index:
+                                self.do_index(c, barcode, inpath_fasta_1, outpath_npy_1, inpath_fasta_2,
+                                              outpath_npy_2)
+                        if self.compress_output:
+                            self.do_compress_outputs(out_fasta_pos, out_fasta_neg)
+                    for temp_fasta in temp_fastas:
+                        os.remove(temp_fasta)
+                    if self.mark_done:
+                        # let the receiver clean up its inputs if it waits for the refilterer
+                        mark_done(self.input_fasta_dir, c, barcode, "refilter")
+                    self.manifest.mark_done(c, barcode, inputs)
                     barcodes_todo.pop(0)
                 else:
                     time.sleep(1)
@@ -0,0 +1,124 @@
+import os
+import time
+import shutil
+import random as rn
+from deepaclive.manifest import Manifest
+
+
+def get_hilive_path(directory, c, barcode):
+    return os.path.join(directory, "hilive_out_cycle{}_{}.bam".format(c, barcode))
+
+
+def get_schedule(cycles, barcodes, cycle_time, jitter=0.0):
+    """Release times (in seconds from the start of the run) of the units of a sequencer-like run.
+
+    The sequencer finishes cycle c after c cycles of cycle_time seconds each, and HiLive writes the outputs of all
+    barcodes at once. With jitter, each release is delayed by a random fraction (up to jitter) of a cycle.
+    """
+    schedule = {}
+    last = 0.0
+    for c in sorted(cycles):
+        # a delayed cycle holds back the following ones
+        last = max(last, c * cycle_time + rn.uniform(0, jitter * cycle_time))
+        for barcode in barcodes:
+            schedule[(c, barcode)] = last
+    return schedule
+
+
+def get_recorded_schedule(source_dir, cycles, barcodes, speedup=1.0):
+    """Release times replaying the modification times of recorded HiLive outputs."""
+    mtimes = {(c, barcode): os.stat(get_hilive_path(source_dir, c, barcode)).st_mtime
+              for c in cycles for barcode in barcodes}
+    first = min(mtimes.values())
+    return {unit: (mtime - first) / speedup for unit, mtime in mtimes.items()}
+
+
+class Replayer:
+    """Release recorded or generated HiLive outputs on a schedule and measure the latency of the live analysis.
+
+    Each file is copied under a temporary name and renamed, so the sender never sees a partial file. A unit counts as
+    sent or classified as soon as it shows up in the manifest of the sender or the receiver, respectively.
+    """
+    def __init__(self, source_dir, target_dir, schedule, manifests, poll_interval=0.2):
+        self.source_dir = os.path.abspath(os.path.realpath(os.path.expanduser(source_dir)))
+        self.target_dir = os.path.abspath(os.path.realpath(os.path.expanduser(target_dir)))
+        if not os.path.isdir(self.target_dir):
+            os.mkdir(self.target_dir)
+        self.schedule = schedule
+        # role -> manifest path
+        self.manifests = manifests
+        self.poll_interval = poll_interval
+        self.released = {}
+        self.done = {role: {} for role in manifests}
+        for c, barcode in schedule:
+            if not os.path.exists(get_hilive_path(self.source_dir, c, barcode)):
+                raise FileNotFoundError("Missing replay input: {}".format(get_hilive_path(self.source_dir, c,
+                                                                                          barcode)))
+            if os.path.exists(get_hilive_path(self.target_dir, c, barcode)):
+                raise FileExistsError("Replay target already exists: {}".format(get_hilive_path(self.target_dir, c,
+                                                                                                barcode)))
+        # units done in previous runs stay in the manifests; only changed entries count
+        self.previous = {role: Manifest(path).units for role, path in manifests.items()}
+
+    def release(self, c, barcode):
+        target = get_hilive_path(self.target_dir, c, barcode)
+        temp_target = os.path.join(self.target_dir, ".{}.replay".format(os.path.basename(target)))
+        shutil.copyfile(get_hilive_path(self.source_dir, c, barcode), temp_target)
+        os.replace(temp_target, target)
+
+    def poll(self, now):
+        for role, path in self.manifests.items():
+            units = Manifest(path).units
+            for unit in self.released:
+                key = Manifest.get_key(*unit)
+                if unit not in self.done[role] and key in units and units[key] != self.previous[role].get(key):
+                    self.done[role][unit] = now
+                    print("Replay: cycle {}, barcode {} {} {:.2f} s after release.".format(
+                        unit[0], unit[1], "classified" if role == "receiver" else "processed by the " + role,
+                        now - self.released[unit]))
+
+    def run(self, is_alive=None):
+        """Release all units and wait until the receiver has classified them (or is_alive returns False)."""
+        pending = sorted(self.schedule.items(), key=lambda item: item[1])
+        start = time.time()
+        while True:
+            now = time.time() - start
+            while len(pending) > 0 and pending[0][1] <= now:
+                (c, barcode), _ = pending.pop(0)
+                self.release(c, barcode)
+                self.released[(c, barcode)] = time.time() - start
+                print("Replay: released cycle {}, barcode {} at {:.2f} s.".format(c, barcode, now))
+            self.poll(time.time() - start)
+            if len(pending) == 0 and len(self.done["receiver"]) == len(self.schedule):
+                break
+            if is_alive is not None and not is_alive():
+                # one last look at the manifests written before the exit
+                self.poll(time.time() - start)
+                break
+            time.sleep(self.poll_interval)
+
+    def get_latencies(self, role="receiver"):
+        return {unit: self.done[role][unit] - released if unit in self.done[role] else None
+                for unit, released in sorted(self.released.items())}
+
+    def report(self, outpath=None):
+        roles = list(self.manifests)
+        lines = ["cycle\tbarcode\treleased\t" + "\t".join("{}_latency".format(role) for role in roles) + "\n"]
+        for (c, barcode), released in sorted(self.released.items()):
+            latencies = [self.done[role].get((c, barcode)) for role in roles]
+            lines.append("{}\t{}\t{:.3f}\t".format(c, barcode, released) + "\t".join(
+                "NA" if done is None else "{:.3f}".format(done - released) for done in latencies) + "\n")
+        if outpath is not None:
+            with open(outpath, 'w') as f:
+                f.writelines(lines)
+
+        latencies = [latency for latency in self.get_latencies().values() if latency is not None]
+        print("Replay: {} of {} units classified.".format(len(latencies), len(self.schedule)))
+        if len(latencies) > 0:
+            print("Replay: latency from release to classified output: mean {:.2f} s, max {:.2f} s.".format(
+                sum(latencies) / len(latencies), max(latencies)))
+        for c in sorted(set(c for c, barcode in self.released)):
+            cycle_latencies = [latency for (cycle, barcode), latency in self.get_latencies().items()
+                               if cycle == c and latency is not None]
+            if len(cycle_latencies) > 0:
+                print("Replay: cycle {}: mean latency {:.2f} s.".format(c, sum(cycle_latencies) / len(cycle_latencies)))
@@ -0,0 +1,116 @@
+import os
+import time
+import threading
+
+
+def get_marker_path(directory, c, barcode, role):
+    return os.path.join(directory, ".hilive_out_cycle{}_{}.{}.done".format(c, barcode, role))
+
+
+def mark_done(directory, c, barcode, role):
+    # tell the owner of the inputs in directory that this role does not need them anymore
+    with open(get_marker_path(directory, c, barcode, role), 'w') as fp:
+        pass
+
+
+def get_usage(directory):
+    usage = 0
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_file(follow_symlinks=False):
+                usage = usage + entry.stat(follow_symlinks=False).st_size
+    return usage
+
+
+class RetentionPolicy:
+    """Delete intermediate files of old cycles once their downstream consumers are done with them.
+
+    Files of a (cycle, barcode) unit are only deleted after all roles in wait_for have left a done marker for the
+    unit in the directory. The last keep_cycles cycles (and the last single-end cycle, if keep_last_single is set) are
+    kept, unless the disk budget (in bytes) is exceeded. In that case, the oldest finished units are deleted first.
+    Producers call wait_for_space before writing new units, so that they wait until the usage falls below the budget
+    again. Consumers only call cleanup, as they would otherwise wait for themselves.
+    """
+    def __init__(self, directory, keep_cycles=None, disk_budget=None, wait_for=(), read_length=None,
+                 keep_last_single=False, poll_interval=10):
+        self.directory = os.path.abspath(os.path.realpath(os.path.expanduser(directory)))
+        self.keep_cycles = keep_cycles
+        self.disk_budget = disk_budget
+        self.wait_for = list(wait_for)
+        self.read_length = read_length
+        self.keep_last_single = keep_last_single
+        self.poll_interval = poll_interval
+        self.units = []
+        self.cycles = []
+        # units may be registered and released from different threads
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # locks cannot be pickled, e.g. when the owner is sent to a worker process
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def register(self, c, barcode, paths):
+        with self.lock:
+            if c not in self.cycles:
+                self.cycles.append(c)
+            self.units.append((c, barcode, [p for p in set(paths) if len(p) > 0]))
+
+    def is_consumed(self, c, barcode):
+        return all([os.path.exists(get_marker_path(self.directory, c, barcode, role)) for role in self.wait_for])
+
+    def get_protected_cycles(self):
+        protected = set()
+        if self.keep_cycles is not None:
+            protected.update(self.cycles[-self.keep_cycles:] if self.keep_cycles > 0 else [])
+        else:
+            protected.update(self.cycles)
+        if self.keep_last_single and self.read_length is not None:
+            single_cycles = [c for c in self.cycles if c <= self.read_length]
+            if len(single_cycles) > 0:
+                protected.add(single_cycles[-1])
+        return protected
+
+    def remove_unit(self, unit):
+        c, barcode, paths = unit
+        for path in paths + [get_marker_path(self.directory, c, barcode, role) for role in self.wait_for]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.units.remove(unit)
+
+    def cleanup(self):
+        with self.lock:
+            protected = self.get_protected_cycles()
+            for unit in self.units[:]:
+                if unit[0] not in protected and self.is_consumed(unit[0], unit[1]):
+                    self.remove_unit(unit)
+            if self.disk_budget is not None:
+                # over budget, give up on keeping cycles, oldest first; waiting would not free consumed units
+                # of the latest cycle, so these may go as well
+                for unit in self.units[:]:
+                    if get_usage(self.directory) <= self.disk_budget:
+                        break
+                    if self.is_consumed(unit[0], unit[1]):
+                        self.remove_unit(unit)
+
+    def wait_for_space(self):
+        self.cleanup()
+        if self.disk_budget is None:
+            return
+        waited = False
+        while get_usage(self.directory) > self.disk_budget:
+            if not waited:
+                print("Disk budget of {:.2f} GB exceeded in {}. Waiting for downstream consumers...".format(
+                    self.disk_budget / 1e9, self.directory))
+                waited = True
+            time.sleep(self.poll_interval)
+            self.cleanup()
+        if waited:
+            print("Disk usage in {} back within budget.".format(self.directory))
@@ -2,12 +2,16 @@ import pysam
 import os
 import time
 from deepaclive.sftp_client import sftp_push
-from multiprocessing import cpu_count
+from deepaclive.compression import bgzip_file, report_compression
+from deepaclive.manifest import Manifest, get_manifest_path
+from deepaclive.profiling import null_context
+from multiprocessing import cpu_count, Pool
 
 
 class Sender:
     def __init__(self, read_length, input_dir, output_dir, user_hostname=None, key=None, port=22, n_cpus=None,
-                 do_all=False, do_mapped=False):
+                 do_all=False, do_mapped=False, compression_level=None, retention=None,
+                 resume=False, profiler=None):
         print("Setting up the sender...")
         self.input_dir = os.path.abspath(os.path.realpath(os.path.expanduser(input_dir)))
         self.output_dir = os.path.abspath(os.path.realpath(os.path.expanduser(output_dir)))
@@ -20,6 +24,12 @@ class Sender:
         self.do_mapped = do_mapped
         self.cores = n_cpus if n_cpus is not None else cpu_count()
         self.c_threads = str(self.cores - 1)
+        self.compression_level = compression_level
+        self.retention = retention
+        self.resume = resume
+        # checksums are only needed to recognize unchanged inputs when resuming
+        self.manifest = Manifest(get_manifest_path(self.output_dir, "sender"), checksums=resume)
+        self.profiler = profiler
         self.user_hostname = user_hostname
         self.pkey = key
         if user_hostname is not None:
@@ -34,137 +44,231 @@ class Sender:
         self.port = port
         print("Sender ready.")
 
-    def run(self, cycles, barcodes, mode="bam"):
+    def extract(self, c, barcode, mode="bam", c_threads=None):
+        if c_threads is not None:
+            # called in a worker process with its own copy of the sender
+            self.c_threads = c_threads
+        start = time.time()
+        single = c <= self.read_length
+        inpath = self.get_inpath(c, barcode)
+        outpath = os.path.join(self.output_dir, "hilive_out_cycle{}_{}_deepac".format(c, barcode))
+        if mode == "bam" or mode == "cram":
+            if self.do_mapped:
+                outfiles = self.get_mapped_bam(inpath, outpath, single, ext=mode)
+            else:
+                outfiles = self.get_unmapped_bam(inpath, outpath, single, do_filter=self.do_filter, ext=mode)
+        elif mode == "fasta" or mode == "fasta.gz":
+            if self.do_mapped:
+                outfiles = self.get_mapped_fasta(inpath, outpath, single, ext=mode)
+            else:
+                outfiles = self.get_unmapped_fasta(inpath, outpath, single, do_filter=self.do_filter, ext=mode)
+        else:
+            raise ValueError("Unrecognized sender format: {}".format(mode))
+        print("Extracted cycle {}, barcode {} in {:.2f} s.".format(c, barcode, time.time() - start))
+        return [f for f in outfiles if len(f) > 0]
+
+    def get_inpath(self, c, barcode):
+        return os.path.join(self.input_dir, "hilive_out_cycle{}_{}.bam".format(c, barcode))
+
+    def is_done(self, c, barcode):
+        if self.resume and self.manifest.is_done(c, barcode):
+            print("Skipping cycle {}, barcode {}: already done.".format(c, barcode))
+            return True
+        return False
+
+    def is_profiled(self, c, barcode):
+        return self.profiler is not None and self.profiler.sample(c, barcode)
+
+    def extract_unit(self, c, barcode, mode="bam", c_threads=None, profile=False, summarize=True):
+        with self.profiler.unit(c, barcode, summarize) if profile else null_context():
+            return self.extract(c, barcode, mode, c_threads)
+
+    def do_release(self, c, barcode_files):
+        for barcode, files in barcode_files:
+            self.manifest.mark_done(c, barcode, [self.get_inpath(c, barcode)])
+        if self.retention is None:
+            return
+        if self.user_hostname is not None:
+            # sent files are not needed anymore
+            for barcode, files in barcode_files:
+                self.retention.register(c, barcode, files)
+            self.retention.cleanup()
+
+    def wait_for_space(self):
+        # locally, the outputs are cleaned up by the receiver
+        if self.retention is not None and self.user_hostname is None:
+            self.retention.wait_for_space()
+
+    def run(self, cycles, barcodes, mode="bam", n_jobs=1):
+        if mode not in ("bam", "cram", "fasta", "fasta.gz"):
+            raise ValueError("Unrecognized sender format: {}".format(mode))
+        if n_jobs > 1:
+            self.run_parallel(cycles, barcodes, mode, n_jobs)
+            return
         # copy by value
         cycles_todo = cycles[:]
         while len(cycles_todo) > 0:
             c = cycles_todo[0]
-            single = c <= self.read_length
+            self.wait_for_space()
             barcodes_todo = barcodes[:]
-            files = []
+            barcode_files = []
             while len(barcodes_todo) > 0:
                 barcode = barcodes_todo[0]
-                inpath = os.path.join(self.input_dir, "hilive_out_cycle{}_{}.bam".format(c, barcode))
-                if os.path.exists(inpath):
+                if self.is_done(c, barcode):
+                    barcodes_todo.pop(0)
+                elif os.path.exists(self.get_inpath(c, barcode)):
                     print("Processing cycle {}, barcode {}.".format(c, barcode))
-                    outpath = os.path.join(self.output_dir, "hilive_out_cycle{}_{}_deepac".format(c, barcode))
-                    if mode == "bam":
-                        if self.do_mapped:
-                            outfiles = self.get_mapped_bam(inpath, outpath, single)
-                        else:
-                            outfiles = self.get_unmapped_bam(inpath, outpath, single, do_filter=self.do_filter)
-                    elif mode == "fasta":
-                        if self.do_mapped:
-                            outfiles = self.get_mapped_fasta(inpath, outpath, single)
-                        else:
-                            outfiles = self.get_unmapped_fasta(inpath, outpath, single, do_filter=self.do_filter)
-                    else:
-                        raise ValueError("Unrecognized sender format: {}".format(mode))
-                    files.append(outfiles[0])
-                    if len(outfiles[1]) > 0:
-                        files.append(outfiles[1])
+                    barcode_files.append((barcode, self.extract_unit(c, barcode, mode,
+                                                                      profile=self.is_profiled(c, barcode))))
                     barcodes_todo.pop(0)
                 else:
                     time.sleep(1)
             if self.user_hostname is not None:
+                files = [f for barcode, outfiles in barcode_files for f in outfiles]
                 sftp_push(self.user_hostname, files=files, key=self.pkey, port=self.port)
+            self.do_release(c, barcode_files)
             cycles_todo.pop(0)
             if len(cycles_todo) > 0:
                 print("Done. Sender awaiting cycle {}.".format(cycles_todo[0]))
             else:
                 print("Sender done.")
 
-    def get_unmapped_fasta(self, inpath, outpath, single=False, do_filter=True):
-        # set output in both pysam wrapper and samtools argument list
-        outpath_fasta_1 = outpath + "_1.fasta"
+    def run_parallel(self, cycles, barcodes, mode="bam", n_jobs=2):
+        # split the cores between the jobs; each samtools call uses its main thread plus c_threads extra ones
+        job_threads = str(max(self.cores // n_jobs, 1) - 1)
+        # copy by value
+        cycles_todo = cycles[:]
+        with Pool(processes=n_jobs) as pool:
+            while len(cycles_todo) > 0:
+                c = cycles_todo[0]
+                self.wait_for_space()
+                start = time.time()
+                barcodes_todo = barcodes[:]
+                jobs = {}
+                profiled = set()
+                while len(barcodes_todo) > 0 or len(jobs) > 0:
+                    for barcode in barcodes_todo[:]:
+                        if self.is_done(c, barcode):
+                            barcodes_todo.remove(barcode)
+                        elif os.path.exists(self.get_inpath(c, barcode)):
+                            print("Processing cycle {}, barcode {}.".format(c, barcode))
+                            profile = self.is_profiled(c, barcode)
+                            if profile:
+                                profiled.add(barcode)
+                            # workers only dump their profiles, the summary is kept here
+                            jobs[barcode] = pool.apply_async(self.extract_unit, (c, barcode, mode, job_threads,
+                                                                                profile, False))
+                            barcodes_todo.remove(barcode)
+                    done = [barcode for barcode in jobs if jobs[barcode].ready()]
+                    if len(done) > 0:
+                        # send the results of all finished jobs over a single connection
+                        barcode_files = [(barcode, jobs.pop(barcode).get()) for barcode in done]
+                        for barcode in profiled.intersection(done):
+                            self.profiler.add_unit(c, barcode)
+                        if self.user_hostname is not None:
+                            sftp_push(self.user_hostname, files=[f for _, files in barcode_files for f in files],
+                                      key=self.pkey, port=self.port)
+                        self.do_release(c, barcode_files)
+                    elif len(barcodes_todo) > 0 or len(jobs) > 0:
+                        time.sleep(0.1 if len(jobs) > 0 else 1)
+                print("Cycle {} processed in {:.2f} s.".format(c, time.time() - start))
+                cycles_todo.pop(0)
+                if len(cycles_todo) > 0:
+                    print("Done. Sender awaiting cycle {}.".format(cycles_todo[0]))
+                else:
+                    print("Sender done.")
+
+    def save_fasta(self, outpath_fasta, inpath, *args, paired=False):
+        start = time.time()
+        if outpath_fasta.endswith(".gz") and paired:
+            # samtools writes bgzf compressed output if the file name ends with .gz
+            level = [] if self.compression_level is None else ["-c", str(self.compression_level)]
+            # the filters select reads flagged as READ1 or READ2, which samtools writes to the -o file
+            pysam.fasta(*args, "-@", self.c_threads, *level, "-o", outpath_fasta, inpath)
+            report_compression(outpath_fasta, time.time() - start)
+        elif outpath_fasta.endswith(".gz"):
+            # single reads may be flagged as READ1 or READ2 as well, so keep all of them like plain fasta does
+            plain_fasta = outpath_fasta[:-len(".gz")]
+            self.save_fasta(plain_fasta, inpath, *args)
+            bgzip_file(plain_fasta, outpath_fasta, threads=int(self.c_threads) + 1,
+                       level=self.compression_level if self.compression_level is not None else 6)
+        else:
+            # create the file upfront, so pysam can open it
+            with open(outpath_fasta, 'w') as fp:
+                pass
+            pysam.fasta(*args, "-@", self.c_threads, inpath, save_stdout=outpath_fasta)
+            report_compression(outpath_fasta, time.time() - start)
+
+    def save_bam(self, outpath_bam, inpath, *args):
+        start = time.time()
         # create the file upfront, so pysam can open it
-        with open(outpath_fasta_1, 'w') as fp:
+        with open(outpath_bam, 'w') as fp:
             pass
+        if outpath_bam.endswith(".cram"):
+            # the sequences are stored in the records, so no reference is needed
+            out_format = ["-C", "--output-fmt-option", "no_ref=1"]
+        else:
+            out_format = ["-b"]
+        if self.compression_level is not None:
+            out_format = out_format + ["--output-fmt-option", "level={}".format(self.compression_level)]
+        # set output in both pysam wrapper and samtools argument list
+        pysam.view(*out_format, *args, "-@", self.c_threads, "-o", outpath_bam, inpath, save_stdout=outpath_bam)
+        report_compression(outpath_bam, time.time() - start)
+
+    def get_unmapped_fasta(self, inpath, outpath, single=False, do_filter=True, ext="fasta"):
+        outpath_fasta_1 = "{}_1.{}".format(outpath, ext)
         if single:
             if do_filter:
-                pysam.fasta("-f 4", "-@", self.c_threads, inpath, save_stdout=outpath_fasta_1)
+                self.save_fasta(outpath_fasta_1, inpath, "-f 4")
             else:
-                pysam.fasta(inpath, save_stdout=outpath_fasta_1)
+                self.save_fasta(outpath_fasta_1, inpath)
             return outpath_fasta_1, ""
         else:
+            outpath_fasta_2 = "{}_2.{}".format(outpath, ext)
             if do_filter:
-                pysam.fasta("-Nf 77", "-@", self.c_threads, inpath, save_stdout=outpath_fasta_1)
-                outpath_fasta_2 = outpath + "_2.fasta"
-                # create the file upfront, so pysam can open it
-                with open(outpath_fasta_2, 'w') as fp:
-                    pass
-                pysam.fasta("-Nf 141", "-@", self.c_threads, inpath, save_stdout=outpath_fasta_2)
+                self.save_fasta(outpath_fasta_1, inpath, "-Nf 77", paired=True)
+                self.save_fasta(outpath_fasta_2, inpath, "-Nf 141", paired=True)
             else:
-                pysam.fasta("-Nf 64", "-@", self.c_threads, inpath, save_stdout=outpath_fasta_1)
-                outpath_fasta_2 = outpath + "_2.fasta"
-                # create the file upfront, so pysam can open it
-                with open(outpath_fasta_2, 'w') as fp:
-                    pass
-                pysam.fasta("-Nf 128", "-@", self.c_threads, inpath, save_stdout=outpath_fasta_2)
+                self.save_fasta(outpath_fasta_1, inpath, "-Nf 64", paired=True)
+                self.save_fasta(outpath_fasta_2, inpath, "-Nf 128", paired=True)
             return outpath_fasta_1, outpath_fasta_2
 
-    def get_unmapped_bam(self, inpath, outpath, single=False, do_filter=True):
-        outpath_bam_1 = outpath + "_1.bam"
-        # create the file upfront, so pysam can open it
-        with open(outpath_bam_1, 'w') as fp:
-            pass
-        # set output in both pysam wrapper and samtools argument list
+    def get_unmapped_bam(self, inpath, outpath, single=False, do_filter=True, ext="bam"):
+        outpath_bam_1 = "{}_1.{}".format(outpath, ext)
         if single:
             if do_filter:
-                pysam.view("-bf 4", "-@", self.c_threads, "-o", outpath_bam_1, inpath, save_stdout=outpath_bam_1)
+                self.save_bam(outpath_bam_1, inpath, "-f 4")
             else:
-                pysam.view("-b", "-@", self.c_threads, "-o", outpath_bam_1, inpath, save_stdout=outpath_bam_1)
+                self.save_bam(outpath_bam_1, inpath)
             return outpath_bam_1, ""
         else:
+            outpath_bam_2 = "{}_2.{}".format(outpath, ext)
             if do_filter:
-                pysam.view("-bf 77", "-@", self.c_threads, "-o", outpath_bam_1, inpath, save_stdout=outpath_bam_1)
-                outpath_bam_2 = outpath + "_2.bam"
-                # create the file upfront, so pysam can open it
-                with open(outpath_bam_2, 'w') as fp:
-                    pass
-                pysam.view("-bf 141", "-@", self.c_threads, "-o", outpath_bam_2, inpath, save_stdout=outpath_bam_2)
+                self.save_bam(outpath_bam_1, inpath, "-f 77")
+                self.save_bam(outpath_bam_2, inpath, "-f 141")
             else:
-                pysam.view("-bf 64", "-@", self.c_threads, "-o", outpath_bam_1, inpath, save_stdout=outpath_bam_1)
-                outpath_bam_2 = outpath + "_2.bam"
-                # create the file upfront, so pysam can open it
-                with open(outpath_bam_2, 'w') as fp:
-                    pass
-                pysam.view("-bf 128", "-@", self.c_threads, "-o", outpath_bam_2, inpath, save_stdout=outpath_bam_2)
+                self.save_bam(outpath_bam_1, inpath, "-f 64")
+                self.save_bam(outpath_bam_2, inpath, "-f 128")
             return outpath_bam_1, outpath_bam_2
 
-    def get_mapped_bam(self, inpath, outpath, single=False):
-        outpath_bam_1 = outpath + "_1.bam"
-        # create the file upfront, so pysam can open it
-        with open(outpath_bam_1, 'w') as fp:
-            pass
-        # set output in both pysam wrapper and samtools argument list
+    def get_mapped_bam(self, inpath, outpath, single=False, ext="bam"):
+        outpath_bam_1 = "{}_1.{}".format(outpath, ext)
         if single:
-            pysam.view("-bG 4", "-@", self.c_threads, "-o", outpath_bam_1, inpath, save_stdout=outpath_bam_1)
-
+            self.save_bam(outpath_bam_1, inpath, "-G 4")
             return outpath_bam_1, ""
         else:
-            pysam.view("-bG 12", "-f 64", "-@", self.c_threads, "-o", outpath_bam_1, inpath, save_stdout=outpath_bam_1)
-            outpath_bam_2 = outpath + "_2.bam"
-            # create the file upfront, so pysam can open it
-            with open(outpath_bam_2, 'w') as fp:
-                pass
-            pysam.view("-bG 12", "-f 128", "-@", self.c_threads, "-o", outpath_bam_2, inpath, save_stdout=outpath_bam_2)
+            outpath_bam_2 = "{}_2.{}".format(outpath, ext)
+            self.save_bam(outpath_bam_1, inpath, "-G 12", "-f 64")
+            self.save_bam(outpath_bam_2, inpath, "-G 12", "-f 128")
             return outpath_bam_1, outpath_bam_2
 
-    def get_mapped_fasta(self, inpath, outpath, single=False):
-        # set output in both pysam wrapper and samtools argument list
-        outpath_fasta_1 = outpath + "_1.fasta"
-        # create the file upfront, so pysam can open it
-        with open(outpath_fasta_1, 'w') as fp:
-            pass
+    def get_mapped_fasta(self, inpath, outpath, single=False, ext="fasta"):
+        outpath_fasta_1 = "{}_1.{}".format(outpath, ext)
         if single:
-            pysam.fasta("-G 4", "-@", self.c_threads, inpath, save_stdout=outpath_fasta_1)
+            self.save_fasta(outpath_fasta_1, inpath, "-G 4")
             return outpath_fasta_1, ""
         else:
-            pysam.fasta("-NG 12", "-f 64", "-@", self.c_threads, inpath, save_stdout=outpath_fasta_1)
-            outpath_fasta_2 = outpath + "_2.fasta"
-            # create the file upfront, so pysam can open it
-            with open(outpath_fasta_2, 'w') as fp:
-                pass
-            pysam.fasta("-NG 12", "-f 128", "-@", self.c_threads, inpath, save_stdout=outpath_fasta_2)
+            outpath_fasta_2 = "{}_2.{}".format(outpath, ext)
+            self.save_fasta(outpath_fasta_1, inpath, "-NG 12", "-f 64", paired=True)
+            self.save_fasta(outpath_fasta_2, inpath, "-NG 12", "-f 128", paired=True)
             return outpath_fasta_1, outpath_fasta_2
@@ -0,0 +1,222 @@
+import os
+import bisect
+import h5py
+import numpy as np
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+
+def get_store_path(output_dir, barcode):
+    return os.path.join(output_dir, "hilive_out_{}_predictions.h5".format(barcode))
+
+
+def get_read_name(title):
+    # drop the description and the mate suffix added by samtools fasta -N
+    name = title.split(maxsplit=1)[0] if len(title) > 0 else ""
+    if name.endswith("/1") or name.endswith("/2"):
+        name = name[:-2]
+    return name
+
+
+def iter_titles(inpath_fasta):
+    if not os.path.exists(inpath_fasta) or os.stat(inpath_fasta).st_size == 0:
+        return
+    with open(inpath_fasta) as in_handle:
+        for (title, seq) in SimpleFastaParser(in_handle):
+            yield get_read_name(title)
+
+
+def read_titles(inpath_fasta):
+    return list(iter_titles(inpath_fasta))
+
+
+class SegmentView:
+    """Read-only sequence view of a row range of a dataset, for binary search without loading the range."""
+    def __init__(self, dataset, start, end):
+        self.dataset = dataset
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, i):
+        return int(self.dataset[self.start + i])
+
+
+class ResultStore:
+    """Append-only, chunked and compressed store of the predictions for a single barcode.
+
+    Each row holds a read index, a cycle, a mate (1 or 2) and a score. Read names are kept once in a separate
+    index column. The rows of each cycle are sorted by read index and mate. A row range is committed to the cycle
+    table only after all its rows were written, so that rows left behind by an interrupted append are never visible
+    to the reader. Appending the same cycle again supersedes the previous entry.
+    """
+    ROW_COLUMNS = {"read": np.uint32, "cycle": np.uint16, "mate": np.uint8, "score": np.float32}
+
+    def __init__(self, path, chunk_size=65536, compression="gzip", compression_level=4):
+        self.path = os.path.abspath(os.path.realpath(os.path.expanduser(path)))
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.compression_level = compression_level
+        self.name_index = None
+
+    def __create(self, f):
+        f.create_dataset("names", shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(),
+                         chunks=(self.chunk_size,), compression=self.compression,
+                         compression_opts=self.compression_level)
+        for column, dtype in self.ROW_COLUMNS.items():
+            f.create_dataset(column, shape=(0,), maxshape=(None,), dtype=dtype, chunks=(self.chunk_size,),
+                             compression=self.compression, compression_opts=self.compression_level, shuffle=True)
+        # cycle, first row, end row
+        f.create_dataset("cycles", shape=(0, 3), maxshape=(None, 3), dtype=np.int64, chunks=(1024, 3))
+
+    def __load_index(self, f):
+        if self.name_index is None:
+            self.name_index = {name: i for i, name in enumerate(f["names"].asstr()[:])}
+        return self.name_index
+
+    @staticmethod
+    def __append_column(dataset, values, start):
+        dataset.resize((start + len(values),))
+        dataset[start:] = values
+
+    def append(self, cycle, inpath_fasta_1, preds_npy_1, inpath_fasta_2=None, preds_npy_2=None):
+        mates = [(1, inpath_fasta_1, preds_npy_1)]
+        if inpath_fasta_2 is not None:
+            mates.append((2, inpath_fasta_2, preds_npy_2))
+
+        try:
+            self.__append(cycle, mates)
+        except Exception:
+            # the cached name index may hold names that were never written
+            self.name_index = None
+            raise
+
+    def __append(self, cycle, mates):
+        with h5py.File(self.path, "a") as f:
+            if "cycles" not in f:
+                self.__create(f)
+            index = self.__load_index(f)
+            cycle_table = f["cycles"]
+            # discard rows of an uncommitted append
+            start = int(cycle_table[-1, 2]) if cycle_table.shape[0] > 0 else 0
+            n_names = f["names"].shape[0]
+            new_names = []
+            segment = {column: [] for column in self.ROW_COLUMNS}
+            for mate, inpath_fasta, preds_npy in mates:
+                if not os.path.exists(inpath_fasta) or os.stat(inpath_fasta).st_size == 0:
+                    continue
+                scores = np.load(preds_npy, mmap_mode='r').reshape(-1)
+                # stream the read names, only new ones are kept
+                ids = np.empty(scores.shape[0], dtype=np.uint32)
+                n_reads = 0
+                for name in iter_titles(inpath_fasta):
+                    read_id = index.get(name)
+                    if read_id is None:
+                        read_id = n_names + len(new_names)
+                        index[name] = read_id
+                        new_names.append(name)
+                    if n_reads < ids.shape[0]:
+                        ids[n_reads] = read_id
+                    n_reads = n_reads + 1
+                if n_reads != scores.shape[0]:
+                    raise ValueError("Found {} predictions for {} reads in {}".format(scores.shape[0], n_reads,
+                                                                                     inpath_fasta))
+                segment["read"].append(ids)
+                segment["cycle"].append(np.full(n_reads, cycle, dtype=np.uint16))
+                segment["mate"].append(np.full(n_reads, mate, dtype=np.uint8))
+                segment["score"].append(scores.astype(np.float32))
+            row = start
+            if len(segment["read"]) > 0:
+                segment = {column: np.concatenate(values) for column, values in segment.items()}
+                # sort the segment by read (and mate), so that reads can be looked up by binary search
+                order = np.lexsort((segment["mate"], segment["read"]))
+                for column, values in segment.items():
+                    self.__append_column(f[column], values[order], start)
+                row = start + len(order)
+            if len(new_names) > 0:
+                self.__append_column(f["names"], new_names, n_names)
+            for column in self.ROW_COLUMNS:
+                f[column].resize((row,))
+            cycle_table.resize((cycle_table.shape[0] + 1, 3))
+            cycle_table[-1] = (cycle, start, row)
+
+    def __segments(self, f):
+        # latest committed row range of each cycle
+        segments = {}
+        for cycle, start, end in f["cycles"][:]:
+            segments[int(cycle)] = (int(start), int(end))
+        return dict(sorted(segments.items()))
+
+    def cycles(self):
+        with h5py.File(self.path, "r") as f:
+            return list(self.__segments(f).keys())
+
+    def read_names(self, ids=None):
+        with h5py.File(self.path, "r") as f:
+            names = f["names"].asstr()
+            if ids is None:
+                return np.asarray(names[:], dtype=object)
+            ids = np.asarray(ids)
+            if ids.size == 0:
+                return np.empty(0, dtype=object)
+            # h5py fancy indexing requires increasing indices
+            unique_ids, inverse = np.unique(ids, return_inverse=True)
+            return np.asarray(names[unique_ids], dtype=object)[inverse]
+
+    def get_cycle(self, cycle, mate=None):
+        """Get the read indices, mates and scores stored for a cycle."""
+        with h5py.File(self.path, "r") as f:
+            segments = self.__segments(f)
+            if cycle not in segments:
+                raise KeyError("Cycle {} not found in {}".format(cycle, self.path))
+            start, end = segments[cycle]
+            reads = f["read"][start:end]
+            mates = f["mate"][start:end]
+            scores = f["score"][start:end]
+        if mate is not None:
+            keep = mates == mate
+            reads, mates, scores = reads[keep], mates[keep], scores[keep]
+        return reads, mates, scores
+
+    def history(self, name):
+        """Get the scores of a read over all stored cycles as (cycle, mate, score) tuples."""
+        with h5py.File(self.path, "r") as f:
+            index = self.__load_index(f)
+            if name not in index:
+                # the store may have grown since the index was cached
+                self.name_index = None
+                index = self.__load_index(f)
+            if name not in index:
+                raise KeyError("Read {} not found in {}".format(name, self.path))
+            read_id = index[name]
+            history = []
+            for cycle, (start, end) in self.__segments(f).items():
+                # segments are sorted by read, so only the chunks on the search path are read
+                rows = SegmentView(f["read"], start, end)
+                first = bisect.bisect_left(rows, read_id)
+                last = bisect.bisect_right(rows, read_id, lo=first)
+                if last > first:
+                    mates = f["mate"][start + first:start + last]
+                    scores = f["score"][start + first:start + last]
+                    history.extend((cycle, int(mate), float(score)) for mate, score in zip(mates, scores))
+        return history
+
+    def summary(self, threshold=0.5):
+        """Count reads (or read pairs) and the fraction classified as positive in each cycle."""
+        summary = []
+        with h5py.File(self.path, "r") as f:
+            for cycle, (start, end) in self.__segments(f).items():
+                mates = f["mate"][start:end]
+                scores = f["score"][start:end]
+                y_pred = scores[mates == 1]
+                scores_2 = scores[mates == 2]
+                if scores_2.shape[0] > 0:
+                    # classify pairs by the mean of both mates, as in filter_paired_fasta
+                    y_pred = (y_pred + scores_2) / 2
+                n_reads = y_pred.shape[0]
+                n_pos = int(np.sum(y_pred > threshold))
+                summary.append({"cycle": cycle, "reads": n_reads, "positive": n_pos,
+                                "positive_fraction": n_pos / n_reads if n_reads > 0 else 0.0,
+                                "mean_score": float(np.mean(y_pred)) if n_reads > 0 else float("nan")})
+        return summary
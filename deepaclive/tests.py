@@ -2,7 +2,11 @@ from deepac.tests.datagen import generate_read
 import os
 from deepaclive.receiver import Receiver
 from deepaclive.sender import Sender
+from deepaclive.store import ResultStore, get_store_path
+from deepaclive.index import ReadIndex, get_index_path
 import pysam
+import numpy as np
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 
 
 def generate_sample_sams(n, filename_prefix, cycles, barcodes, barcode_len=8,
@@ -27,7 +31,8 @@ def generate_sample_sams(n, filename_prefix, cycles, barcodes, barcode_len=8,
                 for i in range(len(reads_1)):
                     lines.append("read_{id}\t{flag}\t*\t0\t255\t*\t*\t0\t0\t{read}\t*\n".format(
                         id=i,
-                        flag=flag_unpaired,
+                        # single reads may be flagged as mates as well
+                        flag=flags_paired[0] if i == len(reads_1) - 1 else flag_unpaired,
                         read=reads_1[i].seq[:c]))
             else:
                 for i in range(len(reads_1)):
@@ -79,7 +84,7 @@ def run_tests(command="deepac", model="rapid", n_cpus=None, keep=False, scale=1,
 
     receiver = Receiver(command, model=model, read_length=250, input_dir=os.path.join("deepac-live-tests", "rec_in"),
                         output_dir=os.path.join("deepac-live-tests", "rec_out"), n_cpus=n_cpus, threshold=0.5,
-                        tpu_resolver=tpu_resolver)
+                        tpu_resolver=tpu_resolver, backend="both", read_index=True)
     sender = Sender(read_length=250, input_dir=os.path.join("deepac-live-tests", "mock_out"),
                     output_dir=os.path.join("deepac-live-tests", "rec_in"), n_cpus=n_cpus)
 
@@ -100,6 +105,40 @@ def run_tests(command="deepac", model="rapid", n_cpus=None, keep=False, scale=1,
     assert (os.path.isfile(os.path.join("deepac-live-tests", "rec_out",
                                         "hilive_out_cycle508_undetermined_predicted_neg.fasta"))), \
         "Receiving or prediction failed."
+    store = ResultStore(get_store_path(os.path.join("deepac-live-tests", "rec_out"), "undetermined"))
+    assert store.cycles() == cycles, "Storing predictions failed."
+    assert len(store.history("read_0")) == len(cycles) + len([c for c in cycles if c > 250]), \
+        "Storing predictions failed."
+    index = ReadIndex(get_index_path(os.path.join("deepac-live-tests", "rec_out"), "undetermined"))
+    assert [entry["cycle"] for entry in index.summary()] == cycles, "Indexing predictions failed."
+    assert index.query(["read_0"])["read_0"]["latest_cycle"] == cycles[-1], "Indexing predictions failed."
 
+    receiver_gz = Receiver(command, model=model, read_length=250,
+                           input_dir=os.path.join("deepac-live-tests", "rec_in_gz"),
+                           output_dir=os.path.join("deepac-live-tests", "rec_out_gz"), n_cpus=n_cpus, threshold=0.5,
+                           tpu_resolver=tpu_resolver, chunk_reads=256)
+    sender_gz = Sender(read_length=250, input_dir=os.path.join("deepac-live-tests", "mock_out"),
+                       output_dir=os.path.join("deepac-live-tests", "rec_in_gz"), n_cpus=n_cpus)
 
+    print("TEST: Filtering and sending compressed data in parallel...")
+    sender_gz.run(cycles=cycles, barcodes=barcodes, mode="fasta.gz", n_jobs=2)
+    assert (os.path.isfile(os.path.join("deepac-live-tests", "rec_in_gz",
+                                        "hilive_out_cycle508_undetermined_deepac_2.fasta.gz"))), \
+        "Parallel filtering or sending failed."
 
+    print("TEST: Receiving compressed data and running pipelined predictions in chunks...")
+    receiver_gz.run(cycles=cycles, barcodes=barcodes, mode="fasta.gz", prefetch=2)
+    for c in cycles:
+        for m in ([1] if c <= 250 else [1, 2]):
+            npy = "hilive_out_cycle{}_undetermined_deepac_{}.npy".format(c, m)
+            assert np.allclose(np.load(os.path.join("deepac-live-tests", "rec_out", npy)),
+                               np.load(os.path.join("deepac-live-tests", "rec_out_gz", npy)), atol=1e-5), \
+                "Pipelined predictions differ from sequential predictions."
+        for label in ["pos", "neg"]:
+            fasta = "hilive_out_cycle{}_undetermined_predicted_{}.fasta".format(c, label)
+            # compare read names and sequences; the printed potentials may differ in the last digit
+            records = []
+            for out_dir in ["rec_out", "rec_out_gz"]:
+                with open(os.path.join("deepac-live-tests", out_dir, fasta)) as in_handle:
+                    records.append([(title.split()[0], seq) for (title, seq) in SimpleFastaParser(in_handle)])
+            assert records[0] == records[1], "Pipelined filtering differs from sequential filtering."
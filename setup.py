@@ -34,7 +34,8 @@ setup(name='deepaclive',
           'matplotlib>=3.1.3',
           'scikit-learn>=0.22.1',
           'numpy>=1.18.1',
-          'biopython>=1.76'
+          'biopython>=1.76',
+          'h5py>=3.0.0'
       ],
       entry_points={
           'console_scripts': ['deepac-live=deepaclive.command_line:main'],